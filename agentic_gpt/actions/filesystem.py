@@ -2,12 +2,49 @@
 
 For now do not allow any actions that could be destructive."""
 import os
+import codecs
 
+# Files larger than this are read in pieces of this many bytes, so that one
+# large file doesn't get loaded into memory, and into the prompt, at once.
+MAX_INLINE_BYTES = 256_000
 
-def get_file_contents(filename):
-    """Reads file into memory."""
-    with open(filename, "r") as f:
-        return f.read()
+
+def _decode(data, final):
+    """Decode UTF-8 bytes the way reading a file in text mode would, with
+    universal newlines. Unless the bytes are `final`, a character or a
+    "\r\n" cut off at their end is left for the next piece. Returns the
+    text and the number of bytes it was decoded from."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    text = decoder.decode(data, final=final)
+    consumed = len(data) - len(decoder.getstate()[0])
+    if not final and text.endswith("\r"):
+        text = text[:-1]
+        consumed -= 1
+    return text.replace("\r\n", "\n").replace("\r", "\n"), consumed
+
+
+def get_file_contents(filename, offset=0):
+    """Reads file into memory. Large files are read one piece at a time;
+    pass the `offset` given at the end of a piece to read the next one."""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if not offset and size <= MAX_INLINE_BYTES:
+            # Read small files with a single system call.
+            return _decode(os.read(fd, size), final=True)[0]
+        os.lseek(fd, offset, os.SEEK_SET)
+        data = os.read(fd, MAX_INLINE_BYTES)
+    finally:
+        os.close(fd)
+
+    contents, consumed = _decode(data, final=offset + len(data) >= size)
+    end = offset + consumed
+    if end < size:
+        contents += (
+            f"\n\n[Read bytes {offset} to {end} of {size}. To read more, call "
+            f"get_file_contents with offset={end}.]"
+        )
+    return contents
 
 
 def list_dir(path):
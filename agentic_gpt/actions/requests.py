@@ -1,14 +1,29 @@
 """Helpful function for the agent to make requests."""
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
+# Share one session so that connections to the same host are kept alive and
+# reused rather than set up again for every request.
+_SESSION = requests.Session()
+
+# Maximum number of requests which `get_all` makes at the same time.
+MAX_CONCURRENT_REQUESTS = 8
+
 
 def get(url):
     """Reads request text into memory."""
-    r = requests.get(url)
+    r = _SESSION.get(url)
     return r.text
 
 
 def post(url, data):
     """Reads request text into memory."""
-    r = requests.post(url, data=data)
+    r = _SESSION.post(url, data=data)
     return r.text
+
+
+def get_all(urls):
+    """Reads the text of every url into memory, fetching them concurrently.
+    Returns a list of texts in the same order as `urls`."""
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(get, urls))
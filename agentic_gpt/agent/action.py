@@ -1,5 +1,7 @@
 """Action class abstraction."""
-from inspect import signature
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from inspect import isawaitable, signature
 from typing import Callable
 
 
@@ -13,10 +15,16 @@ class Action:
         self.name = name
         self.description = description
         self.function = function
+        # Inspecting the signature is slow, so render the string only once.
+        self._str = self.__render()
 
     def to_string(self):
         """Return a string representation of the action, including the
         function signature."""
+        return self._str
+
+    def __render(self):
+        """Render the string representation of the action."""
         func_signature = ", ".join(
             [str(param) for param in signature(self.function).parameters.values()]
         )
@@ -24,6 +32,17 @@ class Action:
             f"`{self.name}`, called with params ({func_signature}): {self.description}"
         )
 
-    def execute(self, *args):
-        """Execute the action with the given arguments."""
-        return self.function(*args)
+    def execute(self, *args, **kwargs):
+        """Execute the action with the given arguments. If the function is
+        async, run it to completion and return its result. If an event loop
+        is already running in this thread, the coroutine is run on its own
+        loop in another thread, since it can't be awaited here."""
+        result = self.function(*args, **kwargs)
+        if not isawaitable(result):
+            return result
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(result)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, result).result()
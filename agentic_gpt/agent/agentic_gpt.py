@@ -1,14 +1,30 @@
 """AgenticGPT class."""
+import os
+import re
 import sys
 import json
+import hashlib
 import logging
-from typing import Dict
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import orjson
 from jinja2 import Environment, DictLoader, meta
 from .action import Action
 from .memory import Memory
 from .errors import AgentError
-from .utils.llm_providers import SUPPORTED_LANGUAGE_MODELS, get_completion
-from .utils.indexing import retrieve_segment_of_text
+from .utils.llm_providers import (
+    SUPPORTED_LANGUAGE_MODELS,
+    get_completion,
+    get_json_completion,
+)
+from .utils.parsing import repair_json
+from .utils.indexing import (
+    retrieve_segment_of_text,
+    get_embed_model,
+    cosine_similarity,
+)
 from ..actions.ai_functions import ask_llm, CLARIFY_FUNCTION
 
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +33,16 @@ logger = logging.getLogger(__name__)
 
 SUPPORTED_EMBEDDING_MODELS = ["text-embedding-ada-002", "sentencetransformers"]
 
+# Responses which were successfully parsed, keyed on a hash of the model and
+# the prompt. The agent always samples at temperature 0, so an identical prompt
+# (e.g., when rerunning the same objective in the same process) would get the
+# same response anyway. Unlike the cache in `get_completion`, responses which
+# could not be parsed are never reused.
+RESPONSE_CACHE = {}
+RESPONSE_CACHE_MAX_SIZE = 1024
+# Agents run by `run_batch` share the cache from several threads.
+_response_cache_lock = threading.Lock()
+
 """Define default actions for the agent."""
 
 DONE_FUNCTION = "declare_done"
@@ -28,15 +54,35 @@ def declare_done():
 
 ASK_LLM_FUNCTION = "ask_ai"
 
+# When `enable_auto_done` is set, the agent declares itself done without asking
+# the LLM once the embedding of the latest action's result is at least this
+# similar to the embedding of the objective. The threshold depends on the
+# embedding model, since ada-002's similarities are squeezed into roughly
+# 0.7 to 1.0 while sentence-transformers' spread over the whole range.
+AUTO_DONE_THRESHOLDS = {
+    "text-embedding-ada-002": 0.92,
+    "sentencetransformers": 0.85,
+}
+AUTO_DONE_RESULT_LENGTH = 2000
+
 
-"""Prompt to be called at every time step for the agent."""
+"""Prompt to be called at every time step for the agent. It is split into a
+static prefix, which is formatted once per agent, and a dynamic suffix, which is
+formatted at every step. Keeping the prefix byte-identical across steps lets the
+provider reuse its prompt cache for it."""
 
-AGENT_PROMPT = """You are an AI agent given the following objective: "{objective}"
+AGENT_PROMPT_PREFIX = """You are an AI agent given the following objective: "{objective}"
 
 =============================================================
 You can take the following actions. args are denoted as (arg1: str, arg2: int), and kwargs are denoted as (kwarg1="default_value").
 {actions}
 
+=============================================================
+At every step you will be asked for your next action. Please only choose ONE action at a time.
+{response_instructions}
+"""
+
+AGENT_PROMPT_SUFFIX = """
 =============================================================
 These files / variables are available to you in your memory:
 {files}
@@ -50,38 +96,115 @@ Here is some potentially helpful context about your environment:
 {context}
 
 =============================================================
-What is your next action? Please only choose ONE action at a time. Answer with a JSON with the below form which can be loaded with Python `json.loads`. Example:
-{example_response_format}
+What is your next action?
 
 """
 
-EXAMPLE_RESPONSE_FORMAT = """
-{
-    "thoughts": {
-        "text": "<your thought>",
-        "reasoning": "<your reasoning>"
-    },
-    "command": {
-        "action": "selected_action_name",
-        "args": ["arg1", "arg2"],
-        "kwargs": {
-            "kwarg1": "kwarg1_value",
-            "kwarg2": "kwarg2_value"
-        }
-    }
-}
+# The literal text around the placeholders of AGENT_PROMPT_SUFFIX, split once
+# so that the prompt can be joined at every step without parsing the template.
+(
+    _SUFFIX_BEFORE_FILES,
+    _SUFFIX_BEFORE_ACTIONS_TAKEN,
+    _SUFFIX_BEFORE_CONTEXT,
+    _SUFFIX_END,
+) = re.split(r"\{files\}|\{actions_taken\}|\{context\}", AGENT_PROMPT_SUFFIX)
+
+"""Prompt used to fold the oldest actions taken into a summary, so that the
+list of actions taken in the prompt doesn't grow with every step."""
 
-Where you can use curly braces to denote a variable from memory, e.g., "args": ["{{file_name}}", "arg2"]. To get a variable from memory, you have to reference it verbatim from the list of files above.
-You should provide thoughts and reasoning for your action.
+ACTIONS_SUMMARY_PROMPT = """Below is a summary of the actions that an AI agent took earlier, followed by a list of the actions it took after those.
+Summarize all of these actions in a short paragraph. Keep the names of the actions, any args or kwargs that later actions may depend on, and the order in which they were taken.
 
+Summary of the earlier actions:
+{summary}
+
+Later actions:
+{actions}
+
+Summary: """
+
+ACTIONS_SUMMARY_MODEL = "gpt-3.5-turbo"
+# The model has a 4k context window, so the summary has to leave room for the
+# prompt.
+ACTIONS_SUMMARY_MAX_TOKENS = 512
+
+RESPONSE_INSTRUCTIONS = """You should provide thoughts and reasoning for your action.
+You can use curly braces to denote a variable from memory in the args and kwargs of your command, e.g., "args": ["{{file_name}}", "arg2"]. To get a variable from memory, you have to reference it verbatim from the list of files in your memory.
+"""
+
+LOOKAHEAD_INSTRUCTIONS = """If you are confident about the actions that should follow this one, you can also list them, in order, in "next_commands". They will be taken right after this one unless an action changes the context or fails, in which case you will be asked again.
 """
 
 
+def get_response_schema(action_names, lookahead_k=1):
+    """Get the JSON schema which the agent's response has to follow, given
+    the names of the actions that it can choose from. If `lookahead_k` is
+    greater than 1, the response may also plan up to `lookahead_k - 1`
+    commands to take after the first one."""
+    command_schema = {
+        "type": "object",
+        "properties": {
+            "action": {"type": "string", "enum": list(action_names)},
+            "args": {"type": "array", "items": {}},
+            "kwargs": {"type": "object"},
+        },
+        "required": ["action"],
+    }
+    schema = {
+        "type": "object",
+        "properties": {
+            "thoughts": {
+                "type": "object",
+                "properties": {
+                    "text": {"type": "string", "description": "Your thought."},
+                    "reasoning": {"type": "string", "description": "Your reasoning."},
+                },
+                "required": ["text", "reasoning"],
+            },
+            "command": command_schema,
+        },
+        "required": ["thoughts", "command"],
+    }
+    if lookahead_k > 1:
+        schema["properties"]["next_commands"] = {
+            "type": "array",
+            "items": command_schema,
+            "maxItems": lookahead_k - 1,
+        }
+    return schema
+
+
+def parse_response(completion):
+    """Parse the agent's JSON response. If it is malformed, try to repair it
+    before giving up, since asking the agent again costs a whole step."""
+    try:
+        return orjson.loads(completion)
+    except orjson.JSONDecodeError as exc:
+        try:
+            response_obj = orjson.loads(repair_json(completion))
+        except orjson.JSONDecodeError:
+            raise exc
+        logger.info("Repaired a malformed JSON response.")
+        return response_obj
+
+
+# Environment which every template of a variable from memory is compiled in.
+JINJA_ENV = Environment(loader=DictLoader({}))
+
+
+@lru_cache(maxsize=1024)
+def compile_template(template_string):
+    """Compile a template once; agents tend to reuse the same arg strings."""
+    return JINJA_ENV.from_string(template_string)
+
+
+@lru_cache(maxsize=1024)
 def get_variable_from_jinja2_expression(expression):
     """Helper function to get the first variable name from a Jinja2 expression."""
-    # Create a temporary environment to parse the expression
-    env = Environment()
-    ast = env.parse(expression)
+    # Anything without a brace can't contain a Jinja2 tag, so skip parsing.
+    if "{" not in expression:
+        return None
+    ast = JINJA_ENV.parse(expression)
 
     # Find undeclared variables in the expression
     variables = meta.find_undeclared_variables(ast)
@@ -90,6 +213,15 @@ def get_variable_from_jinja2_expression(expression):
     return next(iter(variables), None)
 
 
+@lru_cache(maxsize=32)
+def cached_retrieve_segment_of_text(query, text, model=None, embedding_model=None):
+    """`retrieve_segment_of_text`, cached for when the context hasn't changed
+    since the last step. Contexts can be long, so only a few are kept."""
+    return retrieve_segment_of_text(
+        query, text, model=model, embedding_model=embedding_model
+    )
+
+
 class AgenticGPT:
     def __init__(
         self,
@@ -101,6 +233,11 @@ class AgenticGPT:
         ask_user_fn=None,
         max_steps=100,
         verbose=False,
+        enable_auto_done=False,
+        actions_window_size=10,
+        checkpoint_path=None,
+        lookahead_k=1,
+        memory_persist_dir=None,
     ):
         """Initialize the agent. An agent is given the following args:
         @param objective: The objective of the agent.
@@ -111,6 +248,11 @@ class AgenticGPT:
         @param ask_user_fn: a function that asks the user a question and returns their answer
         @param max_steps: an integer that specifies the maximum number of steps the agent can take
         @param verbose: a boolean that specifies whether to print out the prompt at every step
+        @param enable_auto_done: a boolean that specifies whether the agent may declare itself done, without asking the LLM, when the result of its latest action closely matches the objective
+        @param actions_window_size: the number of most recent actions which are shown verbatim in the prompt; older ones are summarized. None to always show every action
+        @param checkpoint_path: a path to a JSONL file which every action taken is appended to as soon as it is taken, and which can be loaded with `from_saved_actions`. The file is overwritten when the agent takes its first action
+        @param lookahead_k: the maximum number of actions the agent may plan in a single LLM call. Planned actions after the first are dropped as soon as one changes the context or fails, and the agent lowers this limit when its plans keep getting dropped
+        @param memory_persist_dir: a directory which the indexes of the documents in `memory_dict` are saved to, so that they are loaded rather than embedded again when the agent is rerun
 
         The agent then maintains:
         - a list of actions that it has taken so far
@@ -130,11 +272,32 @@ class AgenticGPT:
         self.objective = objective
         self.max_steps = max_steps
         self.verbose = verbose
-        self.memory = Memory(memory_dict, embedding_model=self.embedding_model)
+        self.enable_auto_done = enable_auto_done
+        self.actions_window_size = actions_window_size
+        self.lookahead_k = lookahead_k
+        self.checkpoint_path = checkpoint_path
+        self._checkpoint = None  # Opened when the first action is taken.
+        self._objective_embedding = None
+        self.memory = Memory(
+            memory_dict,
+            embedding_model=self.embedding_model,
+            persist_dir=memory_persist_dir,
+        )
         self.actions_available = self.__init_actions_available(actions_available)
 
         self.actions_taken = []
+        self._action_lines = []
+        self._actions_summary = ""
+        self._can_summarize_actions = True
+        # The number of the latest result stored in memory for each action.
+        self._result_counts = {}
+        self._actions_taken_str = None  # Cached by `__get_actions_taken`.
         self.context = ""
+        self._done = False
+        self._static_prefix = self.__get_static_prefix()
+        self._response_schema = get_response_schema(
+            self._action_by_name.keys(), self.lookahead_k
+        )
 
     def __init_actions_available(self, given_actions):
         """Initialize the actions available to the agent."""
@@ -174,7 +337,7 @@ class AgenticGPT:
             default_actions.insert(
                 0,
                 Action(
-                    name="ask_user_to_clarify",
+                    name=CLARIFY_FUNCTION,
                     description="Ask the user to clarify their instructions. Used when the information in the context is not enough to proceed to the next step.",
                     function=self.ask_user_fn,
                 ),
@@ -185,39 +348,90 @@ class AgenticGPT:
 
         # Check that the actions_available don't have name collisions with the
         # default actions.
-        for action in given_actions:
-            assert action.name not in [
-                action.name for action in default_actions
-            ], f"Action {action.name} collides with a default action."
+        collisions = {action.name for action in given_actions} & {
+            action.name for action in default_actions
+        }
+        assert not collisions, f"Actions {collisions} collide with default actions."
 
+        # Index the actions by name so that responses can be dispatched
+        # without scanning the list.
+        self._action_by_name = {action.name: action for action in self.actions_available}
+        self._available_actions_str = None
         return self.actions_available
 
     def __get_available_actions(self) -> str:
         """Get a string to inject into the prompt telling the agent what
         actions it can take."""
-        actions = "\n".join(
-            ["- " + action.to_string() for action in self.actions_available]
+        if self._available_actions_str is None:
+            self._available_actions_str = "\n".join(
+                ["- " + action.to_string() for action in self.actions_available]
+            )
+        return self._available_actions_str
+
+    def __get_static_prefix(self) -> str:
+        """Get the part of the prompt which does not change between steps:
+        the objective, the actions available and the response instructions."""
+        response_instructions = RESPONSE_INSTRUCTIONS
+        if self.lookahead_k > 1:
+            response_instructions += LOOKAHEAD_INSTRUCTIONS
+        return AGENT_PROMPT_PREFIX.format(
+            objective=self.objective,
+            actions=self.__get_available_actions(),
+            response_instructions=response_instructions,
         )
-        return actions
 
     def __get_actions_taken(self) -> str:
         """Get a string to inject into the prompt telling the agent what
         actions it has taken so far."""
-
-        actions = []
-        for action in self.actions_taken:
-            action_bullet_str = "- " + action["command"]["action"]
-            if "args" in action["command"]:
-                action_bullet_str += " with args " + str(action["command"]["args"])
-            if "kwargs" in action["command"]:
-                action_bullet_str += " and kwargs " + str(action["command"]["kwargs"])
-            actions.append(action_bullet_str)
-
-        actions = "\n".join(actions)
-        if actions.strip():
-            return actions
-        else:
-            return "None."
+        self.__summarize_old_actions()
+        if self._actions_taken_str is None:
+            actions = "\n".join(self._action_lines)
+            if self._actions_summary:
+                actions = self._actions_summary + "\n" + actions
+            self._actions_taken_str = actions if actions.strip() else "None."
+        return self._actions_taken_str
+
+    def __summarize_old_actions(self):
+        """Once more than twice `actions_window_size` actions are shown
+        verbatim, fold all but the most recent `actions_window_size` of them
+        into the summary. Folding in batches means the summarization call is
+        made once every `actions_window_size` steps rather than every step."""
+        window = self.actions_window_size
+        if window is None or len(self._action_lines) <= 2 * window:
+            return
+        if not self._can_summarize_actions:
+            return
+
+        old_lines = self._action_lines[:-window]
+        prompt = ACTIONS_SUMMARY_PROMPT.format(
+            summary=self._actions_summary or "None.",
+            actions="\n".join(old_lines),
+        )
+        summary = get_completion(
+            prompt, model=ACTIONS_SUMMARY_MODEL, max_tokens=ACTIONS_SUMMARY_MAX_TOKENS
+        )
+        if not isinstance(summary, str):
+            # The API rejected the request, e.g., because the prompt is too
+            # long. It would reject it again at every step, so stop trying.
+            logger.info("Could not summarize old actions: %s", summary)
+            self._can_summarize_actions = False
+            return
+        self._actions_summary = "Summary of earlier actions: " + summary.strip()
+        self._action_lines = self._action_lines[-window:]
+        self._actions_taken_str = None
+
+    def __record_action_taken(self, response_obj):
+        """Record an action that the agent has taken, along with the bullet
+        that describes it in the prompt, so that the list of actions taken
+        doesn't have to be rebuilt at every step."""
+        self.actions_taken.append(response_obj)
+        action_bullet_str = "- " + response_obj["command"]["action"]
+        if "args" in response_obj["command"]:
+            action_bullet_str += " with args " + str(response_obj["command"]["args"])
+        if "kwargs" in response_obj["command"]:
+            action_bullet_str += " and kwargs " + str(response_obj["command"]["kwargs"])
+        self._action_lines.append(action_bullet_str)
+        self._actions_taken_str = None
 
     def __get_memory_string(self) -> str:
         """Get a string to inject into the prompt telling the agent what
@@ -234,7 +448,7 @@ class AgenticGPT:
                 "Find the part of the context which most helps me with objective: "
                 + self.objective
             )
-            source = retrieve_segment_of_text(
+            source = cached_retrieve_segment_of_text(
                 query,
                 self.context,
                 model=self.model,
@@ -243,15 +457,73 @@ class AgenticGPT:
             return source
         return self.context
 
+    def __objective_seems_done(self, result_text) -> bool:
+        """Cheaply check whether the result of the latest action looks like
+        it satisfies the objective, by comparing their embeddings."""
+        result_text = result_text[-AUTO_DONE_RESULT_LENGTH:]
+        if not result_text.strip():
+            return False
+        embed_model = get_embed_model(self.embedding_model)
+        if self._objective_embedding is None:
+            self._objective_embedding = embed_model.get_text_embedding(self.objective)
+        result_embedding = embed_model.get_text_embedding(result_text)
+        similarity = cosine_similarity(self._objective_embedding, result_embedding)
+        return similarity >= AUTO_DONE_THRESHOLDS[self.embedding_model]
+
     def from_saved_actions(self, path: str):
-        """Load the agent from a list of actions taken."""
-        with open(path, "r") as f:
-            saved_dict = json.load(f)
+        """Load the agent from a list of actions taken. `path` is either a
+        JSON file written by `save_actions_taken` or a JSONL checkpoint
+        written by an agent given a `checkpoint_path`."""
+        with open(path, "rb") as f:
+            if path.endswith(".jsonl"):
+                # The first line is the header; the rest are actions.
+                lines = [orjson.loads(line) for line in f if line.strip()]
+                if not lines:
+                    raise ValueError(f"{path} is an empty checkpoint.")
+                saved_dict = {"objective": lines[0]["objective"], "actions": lines[1:]}
+            else:
+                saved_dict = orjson.loads(f.read())
             self.objective = saved_dict["objective"]
-            self.actions_taken = saved_dict["actions"]
+            self._objective_embedding = None
+            self.actions_taken = []
+            self._action_lines = []
+            self._actions_summary = ""
+            self._actions_taken_str = None
+            for action in saved_dict["actions"]:
+                if action["command"]["action"] != CLARIFY_FUNCTION:
+                    self.__record_action_taken(action)
+            self._static_prefix = self.__get_static_prefix()
             print("Agent objective: ", self.objective)
             print(f"Loaded f{len(self.actions_taken)} actions.")
 
+    def __checkpoint_action_taken(self, response_obj):
+        """Append an action taken to the checkpoint file, if there is one. The
+        first time, the file is overwritten with the objective followed by
+        every action taken so far, including any loaded with
+        `from_saved_actions`, so that it only ever holds this agent's run."""
+        if self.checkpoint_path is None:
+            return
+        if self._checkpoint is None:
+            self._checkpoint = open(self.checkpoint_path, "wb")
+            self._checkpoint.write(orjson.dumps({"objective": self.objective}) + b"\n")
+            for action in self.actions_taken:
+                self._checkpoint.write(orjson.dumps(action) + b"\n")
+        else:
+            self._checkpoint.write(orjson.dumps(response_obj) + b"\n")
+        self._checkpoint.flush()
+
+    def close(self):
+        """Close the checkpoint file, if it is open."""
+        if self._checkpoint is not None:
+            self._checkpoint.close()
+            self._checkpoint = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def replay(self):
         """Replay the actions taken by the agent."""
         for action in self.actions_taken:
@@ -259,7 +531,7 @@ class AgenticGPT:
 
     def save_actions_taken(self, path: str):
         """Save the actions taken by the agent to a file."""
-        with open(path, "w+") as f:
+        with open(path, "wb+") as f:
             # Iterate through the actions taken and remove the ones where
             # we are asking the user to clarify.
             actions_taken = []
@@ -271,7 +543,7 @@ class AgenticGPT:
                 "objective": self.objective,
                 "actions": actions_taken,
             }
-            json.dump(saved_dict, f, indent=2)
+            f.write(orjson.dumps(saved_dict, option=orjson.OPT_INDENT_2))
 
     def __template_from_memory(self, variable_string):
         """Get variable string from memory."""
@@ -287,7 +559,8 @@ class AgenticGPT:
             return variable_string
 
         # If variable name found, check if the variable is in memory.
-        if variable_name not in self.memory.documents:
+        documents = self.memory.get_documents()
+        if variable_name not in documents:
             raise AgentError(
                 f"{variable_name} is not a valid file in memory. Please try again."
             )
@@ -295,15 +568,14 @@ class AgenticGPT:
         # If it's in memory, then check if the memory document is a string.
         # If not, then we know it's some object that we can't eval, so
         # we just return it.
-        if not isinstance(self.memory.documents[variable_name], str):
-            return self.memory.documents[variable_name]
+        if not isinstance(documents[variable_name], str):
+            return documents[variable_name]
 
         # If it's in memory and the memory document is a string, then we can
         # try to template and eval it. We eval it because it might be a str
         # with quotes that we want to remove.
-        environment = Environment(loader=DictLoader({}))
-        template = environment.from_string(variable_string)
-        result = template.render(self.memory.documents)
+        template = compile_template(variable_string)
+        result = template.render(documents)
         if result != variable_string:  # Dumb check to see if it's the same.
             if not result:
                 raise AgentError(
@@ -315,15 +587,15 @@ class AgenticGPT:
         return result
 
     def __name_action_returned_variable(self, action_name):
-        """Given an `action_name`, check if it has been run before and if so,
-        give it a number to disambiguate it in the agent's memory."""
-        # Iterate through the Memory variables.
-        suffix = 1
-        for key, value in self.memory.documents.items():
-            if action_name in key:
-                # If we find a match, then we know that this action has been
-                # run before, and we can give it a number.
-                suffix += 1
+        """Given an `action_name`, give its result a name which is numbered
+        to disambiguate it in the agent's memory. The numbers only go up, so
+        a result is never overwritten, even if an earlier one was dropped
+        from memory."""
+        documents = self.memory.get_documents()
+        suffix = self._result_counts.get(action_name, 0) + 1
+        while f"{action_name}_result_{suffix}" in documents:
+            suffix += 1
+        self._result_counts[action_name] = suffix
         return action_name + "_result_" + str(suffix)
 
     def process_response(self, response_obj) -> Dict:
@@ -351,66 +623,184 @@ class AgenticGPT:
             if action_kwargs:
                 logger.info("Action kwargs: %s", action_kwargs)
 
-        action_result = None
-        for action in self.actions_available:
-            if action.name == chosen_action:
-                action_result = action.execute(*action_args, **action_kwargs)
-                if isinstance(action_result, dict) and "context" in action_result:
-                    # Reset the context if the action returns a new one.
-                    self.context = action_result["context"]
+        action = self._action_by_name.get(chosen_action)
+        if action is None:
+            raise AgentError(f"{chosen_action} is not a valid action. Please try again.")
+
+        action_result = action.execute(*action_args, **action_kwargs)
+        result_text = ""
+        if isinstance(action_result, dict) and "context" in action_result:
+            # Reset the context if the action returns a new one.
+            self.context = action_result["context"]
+            result_text = str(action_result["context"])
+        else:
+            self.context += "\n\nCommand " + chosen_action + " executed."
+            variable = self.__name_action_returned_variable(action.name)
+
+            successfully_serialized = True
+            try:
+                serialized_result = json.dumps(action_result)
+            except TypeError:
+                successfully_serialized = False
+            if action_result is not None:
+                result_text = (
+                    serialized_result if successfully_serialized else str(action_result)
+                )
+
+            # Index the result in the background, so that it overlaps with
+            # the LLM call for the next step.
+            if action_result is not None:
+                if successfully_serialized:
+                    self.memory.add_document_in_background(variable, serialized_result)
                 else:
-                    self.context += "\n\nCommand " + chosen_action + " executed."
-                    variable = self.__name_action_returned_variable(action.name)
-
-                    successfully_serialized = True
-                    try:
-                        serialized_result = json.dumps(action_result)
-                    except TypeError:
-                        successfully_serialized = False
-                    
-                    if action_result is not None:
-                        if successfully_serialized:
-                            self.memory.add_document(variable, serialized_result)
-                        else:
-                            self.memory.add_document(variable, action_result)
-                        self.context += "\nResult is stored in Memory as: " + variable
-
-                    logger.info(
-                        f"Completed action {chosen_action}. Result: {action_result}"
-                    )
-                break
+                    self.memory.add_document_in_background(variable, action_result)
+                self.context += "\nResult is stored in Memory as: " + variable
+
+            logger.info(f"Completed action {chosen_action}. Result: {action_result}")
+
+        self._done = chosen_action == DONE_FUNCTION
+        if (
+            not self._done
+            and self.enable_auto_done
+            and self.__objective_seems_done(result_text)
+        ):
+            logger.info("Context matches the objective. Declaring done.")
+            self._done = True
 
         return {"agent_response": response_obj, "action_result": action_result}
 
+    def __get_error_context(self, response_obj, exc) -> str:
+        """Get the context which tells the agent that its command failed."""
+        new_context = f"\nJust tried running action "
+        new_context += "`" + response_obj["command"]["action"] + "`"
+        if "args" in response_obj["command"]:
+            new_context += " given args " + str(response_obj["command"]["args"])
+        if "kwargs" in response_obj["command"]:
+            new_context += " and given kwargs " + str(
+                response_obj["command"]["kwargs"]
+            )
+        new_context += "\nIt threw an error: " + str(exc)
+        return new_context
+
+    def __take_next_commands(self, response_obj):
+        """Take the commands which the agent planned after its first one,
+        until one of them finishes the objective, fails or resets the
+        context. A reset context means the rest of the plan was made without
+        seeing it, so the agent is asked again instead."""
+        next_commands = response_obj.get("next_commands") or []
+        next_commands = next_commands[: self.lookahead_k - 1]
+        taken = 0
+        for command in next_commands:
+            if self._done:
+                break
+            next_response_obj = {"thoughts": response_obj["thoughts"], "command": command}
+            try:
+                processed = self.process_response(next_response_obj)
+            except AgentError as exc:
+                self.context = self.__get_error_context(next_response_obj, exc)
+                break
+            self.__record_action_taken(processed["agent_response"])
+            self.__checkpoint_action_taken(processed["agent_response"])
+            taken += 1
+            action_result = processed["action_result"]
+            if isinstance(action_result, dict) and "context" in action_result:
+                break
+
+        # If none of the planned commands could be taken, planning that far
+        # ahead isn't paying off, so plan less next time.
+        if next_commands and not taken and not self._done and self.lookahead_k > 1:
+            self.lookahead_k -= 1
+            # The prompt only mentions "next_commands" while the schema has it.
+            self._static_prefix = self.__get_static_prefix()
+            self._response_schema = get_response_schema(
+                self._action_by_name.keys(), self.lookahead_k
+            )
+            logger.info("Reducing look-ahead to %s actions.", self.lookahead_k)
+
+    @classmethod
+    def run_batch(cls, objectives: List[str], max_workers=4, **kwargs) -> List:
+        """Create and run one agent per objective concurrently, and return
+        the agents once they are all done. `kwargs` are passed to every
+        agent's constructor. Each agent spends most of its time waiting on
+        the LLM API, so the agents are run in a thread pool; `max_workers`
+        bounds how many of them hit the API at the same time. If a
+        `checkpoint_path` is given, each agent checkpoints to its own file,
+        named after it with the agent's index, e.g. run-0.jsonl."""
+        checkpoint_path = kwargs.pop("checkpoint_path", None)
+
+        def create_and_run(i, objective):
+            path = None
+            if checkpoint_path is not None:
+                root, ext = os.path.splitext(checkpoint_path)
+                path = f"{root}-{i}{ext}"
+            with cls(objective, checkpoint_path=path, **kwargs) as agent:
+                agent.run()
+            return agent
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(
+                executor.map(create_and_run, range(len(objectives)), objectives)
+            )
+
     def run(self):
         """Runs the agent."""
 
-        action = None
+        self._done = False
         steps = 0
-        while action is not DONE_FUNCTION and steps < self.max_steps:
-            # Format the prompt and get a completion
-            prompt = AGENT_PROMPT.format(
-                objective=self.objective,
-                actions=self.__get_available_actions(),
-                actions_taken=self.__get_actions_taken(),
-                files=self.__get_memory_string(),
-                context=self.__get_context(),
-                example_response_format=EXAMPLE_RESPONSE_FORMAT,
+        while not self._done and steps < self.max_steps:
+            # Format the prompt and get a completion. Only the suffix changes
+            # from step to step, so the prefix is sent verbatim as the system
+            # message, which the provider can cache.
+            prompt = "".join(
+                [
+                    _SUFFIX_BEFORE_FILES,
+                    self.__get_memory_string(),
+                    _SUFFIX_BEFORE_ACTIONS_TAKEN,
+                    self.__get_actions_taken(),
+                    _SUFFIX_BEFORE_CONTEXT,
+                    self.__get_context(),
+                    _SUFFIX_END,
+                ]
             )
-            completion = get_completion(prompt, model=self.model)
+            cache_key = hashlib.sha256(
+                "\n".join([self.model, self._static_prefix, prompt]).encode()
+            ).hexdigest()
+            with _response_cache_lock:
+                completion = RESPONSE_CACHE.get(cache_key)
+            if completion is not None:
+                logger.info("Prompt seen before. Reusing the cached response.")
+            else:
+                completion = get_json_completion(
+                    prompt,
+                    model=self.model,
+                    json_schema=self._response_schema,
+                    system=self._static_prefix,
+                )
             steps += 1
 
             logger.info(f"Taken steps {steps} of maximum {self.max_steps}.")
 
+            if isinstance(completion, dict):
+                # The API rejected the request, e.g., because the prompt was
+                # too long. Replace the context, which is the likeliest part
+                # to have grown too long, with the error.
+                logger.info("!!! LANGUAGE MODEL ERROR: %s", completion["error"])
+                self.context = (
+                    "\nThe last request to the language model failed: "
+                    + completion["error"]
+                    + "\nPlease try again."
+                )
+                continue
+
             if self.verbose:
-                logger.info("PROMPT: \n" + prompt)
+                logger.info("PROMPT: \n" + self._static_prefix + prompt)
                 logger.info("AGENT RESPONSE: " + completion)
 
             # Try loading the completion as JSON.
             try:
-                response_obj = json.loads(completion)
+                response_obj = parse_response(completion)
             except json.decoder.JSONDecodeError as exc:
-                logger.info(prompt)
+                logger.info(self._static_prefix + prompt)
                 logger.info(
                     "!!! INVALID JSON RESPONSE. Prompt shown above, completion below."
                 )
@@ -423,6 +813,12 @@ class AgenticGPT:
                 self.context = self.context + "\nPlease try again."
                 continue
 
+            with _response_cache_lock:
+                if cache_key not in RESPONSE_CACHE:
+                    if len(RESPONSE_CACHE) >= RESPONSE_CACHE_MAX_SIZE:
+                        del RESPONSE_CACHE[next(iter(RESPONSE_CACHE))]
+                    RESPONSE_CACHE[cache_key] = completion
+
             # TODO eventually figure this out
             # if self.chat_mode:
             #     message = "My thoughts are that: " + response_obj["thoughts"]["text"]
@@ -435,24 +831,20 @@ class AgenticGPT:
                 processed = self.process_response(response_obj)
             except AgentError as exc:
                 # Construct new context with error message.
-                new_context = f"\nJust tried running action "
-                new_context += "`" + response_obj["command"]["action"] + "`"
-                if "args" in response_obj["command"]:
-                    new_context += " given args " + str(response_obj["command"]["args"])
-                if "kwargs" in response_obj["command"]:
-                    new_context += " and given kwargs " + str(
-                        response_obj["command"]["kwargs"]
-                    )
-                new_context += "\nIt threw an error: " + str(exc)
-                self.context = new_context
+                self.context = self.__get_error_context(response_obj, exc)
                 continue
 
             # Some housekeeping.
-            self.actions_taken.append(processed["agent_response"])
-            response_obj = processed["agent_response"]
+            self.__record_action_taken(processed["agent_response"])
+            self.__checkpoint_action_taken(processed["agent_response"])
+
+            # Take any commands the agent planned after this one, unless this
+            # one reset the context.
             action_result = processed["action_result"]
-            action = response_obj["command"]["action"]
+            if self.lookahead_k > 1 and not (
+                isinstance(action_result, dict) and "context" in action_result
+            ):
+                self.__take_next_commands(response_obj)
 
-            if action == DONE_FUNCTION:
-                logger.info("You have completed your objective!")
-                return
+        if self._done:
+            logger.info("You have completed your objective!")
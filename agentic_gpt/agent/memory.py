@@ -4,9 +4,61 @@ The Context class abstracts the details of the context from the agent. It
 takes care of embedding the documents, indexing them, and retrieving
 them, as well as the bookkeeping of the documents.
 """
-from llama_index import Document
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from llama_index import Document, GPTVectorStoreIndex, StorageContext
 from typing import Dict
-from .utils.indexing import init_index, summarize_documents, retrieve_segment_of_text
+from .utils.indexing import (
+    init_index,
+    index_documents,
+    get_embedded_nodes,
+    get_service_context,
+    persist_index,
+    load_index,
+    gather_with_limit,
+    summarize_indexes,
+    retrieve_segment_of_text,
+    DEFAULT_SUMMARY_QUERY,
+    MAX_CONCURRENT_QUERIES,
+)
+from .utils.embedding_cache import EmbeddingCache, content_hash, DEFAULT_CACHE_PATH
+from .errors import AgentError
+
+# The provider and default model which summaries are cached under.
+SUMMARY_PROVIDER = "openai"
+DEFAULT_SUMMARY_MODEL = "gpt-3.5-turbo"
+
+# Answers which say that a document has nothing to do with the query. They are
+# left out when answers from all of the documents are synthesized. Only
+# answers which open with such a refusal match, so that an answer which states
+# a fact and then notes what is missing is kept.
+UNINFORMATIVE_ANSWER_RE = re.compile(
+    r"^((the|this) (provided |given )?(document|text|context|passage) |it |i |there is )?"
+    r"((does not|doesn't|do not|don't) (contain|provide|mention|include|have)"
+    r"|no (relevant )?information|(is )?not (mentioned|provided|specified)"
+    r"|(cannot|can't|am unable to|is unable to|unable to) (be )?(answer|determine|find))",
+    re.IGNORECASE,
+)
+
+
+def filter_answers(answers):
+    """Drop empty, duplicate and uninformative answers, keeping the order of
+    the rest. If no answer is informative, the first non-empty one is kept so
+    that there is still something to synthesize."""
+    filtered = []
+    seen = set()
+    for answer in answers:
+        normalized = " ".join((answer or "").lower().split())
+        if not normalized or normalized in seen:
+            continue
+        seen.add(normalized)
+        if not UNINFORMATIVE_ANSWER_RE.match(normalized):
+            filtered.append(answer)
+    if not filtered:
+        filtered = [answer for answer in answers if answer and answer.strip()][:1]
+    return filtered
 
 
 class Memory:
@@ -17,41 +69,166 @@ class Memory:
         documents: Dict = {},
         model="gpt-3.5-turbo",
         embedding_model=None,
+        cache_path=DEFAULT_CACHE_PATH,
+        persist_dir=None,
+        vector_store_factory=None,
     ):
         """A Memory object is initialized with a list of documents.
         It keeps track of a few things about the documents:
         - `self.documents`: The documents themselves, stored in `name`: `text` pairs.
         - `self.document_store`: A dict of `name`: to {"text": `text`, "summary": `summary`, "index": `index`}
-        - `self.vector_index`: A vector index over all of the texts.
+        - `self.router_index`: A vector index over all of the texts. It is
+          only built once `query_one` needs it.
+
+        The documents are summarized and indexed in the background; anything
+        which needs their summaries or indexes waits for that to finish.
+
+        Summaries are cached on disk at `cache_path`, so that documents which
+        haven't changed aren't summarized again. Pass None to disable it.
+
+        If `persist_dir` is given, the indexes of the documents are saved
+        there, and loaded instead of being embedded again the next time a
+        Memory is created with the same documents.
+
+        If `vector_store_factory` is given, it is called with no arguments to
+        create the vector store which the router index keeps its embeddings
+        in, e.g., a quantized FAISS store for a memory with many documents.
+        Otherwise, llama_index's default in-memory store is used.
         """
         self.model = model
         self.embedding_model = embedding_model
-        self.documents = documents
-        if documents:
-            name_and_text = [(name, text) for name, text in documents.items()]
+        self.persist_dir = persist_dir
+        self.vector_store_factory = vector_store_factory
+        self._cache = EmbeddingCache(cache_path) if cache_path else None
+        # Answers to queries, keyed on (query type, query). Cleared whenever
+        # a document is indexed.
+        self._query_cache = {}
+        self._prompt_string = None  # Cached by `to_prompt_string`.
+        # Documents added in the background are indexed one at a time, in
+        # the order they were added. `_lock` guards the document store and
+        # the cached prompt string against the indexing thread.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+        self._lock = threading.Lock()
+        # Copy the documents so that agents given the same dict don't add
+        # documents to each other's memory.
+        self.documents = dict(documents)
+        self.document_store = {}
+        self.router_index = None
+        # Names of the documents which haven't been added to the router index
+        # yet.
+        self._router_pending = list(self.documents.keys())
+        # Summarize and index the documents in the background, so that the
+        # caller can get on with other work in the meantime.
+        self._built = self._executor.submit(
+            self.__build, list(self.documents.items())
+        )
+        self._pending.append(self._built)
 
-            llama_docs = [Document(text=text) for name, text in name_and_text]
-            summary_obj = summarize_documents(
-                llama_docs, model=self.model, embedding_model=self.embedding_model
-            )
+    def __build(self, name_and_text):
+        """Summarize and index the documents the memory was created with."""
+        if not name_and_text:
+            return
 
-            self.document_store = {
-                name: {"text": text, "summary": summary, "index": index}
-                for (name, text), summary, index in zip(
-                    name_and_text, summary_obj["summaries"], summary_obj["indexes"]
-                )
-            }
-            self.router_index = init_index(
-                [Document(text=text) for text in documents.values()],
+        try:
+            summary_obj = self.__summarize(
+                [text for name, text in name_and_text],
+                DEFAULT_SUMMARY_QUERY,
                 model=self.model,
                 embedding_model=self.embedding_model,
             )
-        else:
-            self.document_store = {}
-            self.router_index = init_index(
-                [], model=self.model, embedding_model=self.embedding_model
+        except Exception:
+            self.__drop_documents([name for name, text in name_and_text])
+            raise
+        with self._lock:
+            self.document_store.update(
+                {
+                    name: {"text": text, "summary": summary, "index": index}
+                    for (name, text), summary, index in zip(
+                        name_and_text, summary_obj["summaries"], summary_obj["indexes"]
+                    )
+                }
+            )
+            self._prompt_string = None
+
+    def __drop_documents(self, names):
+        """Forget documents which could not be indexed, so that nothing
+        looks them up in the document store."""
+        with self._lock:
+            for name in names:
+                self.documents.pop(name, None)
+            self._router_pending = [
+                name for name in self._router_pending if name not in names
+            ]
+            self._prompt_string = None
+
+    def __persisted_path(self, kind, texts, embedding_model):
+        """Get the directory an index over `texts` is persisted in. It is named
+        after a hash of the texts, so changed documents are never loaded
+        stale. Returns None if indexes are not persisted."""
+        if self.persist_dir is None:
+            return None
+        key = content_hash(kind, embedding_model or "", *texts)
+        return os.path.join(self.persist_dir, f"{kind}-{key}")
+
+    def __index_texts(self, texts, model=None, embedding_model=None):
+        """Create a vector index for each of the texts, loading the ones which
+        were persisted and persisting the ones which weren't."""
+        paths = [
+            self.__persisted_path("doc", [text], embedding_model) for text in texts
+        ]
+        indexes = [
+            load_index(path, model, embedding_model)
+            if path is not None and os.path.isdir(path)
+            else None
+            for path in paths
+        ]
+
+        missing = [i for i, index in enumerate(indexes) if index is None]
+        new_indexes = index_documents(
+            [Document(text=str(texts[i])) for i in missing],
+            model=model,
+            embedding_model=embedding_model,
+        )
+        for i, index in zip(missing, new_indexes):
+            indexes[i] = index
+            if paths[i] is not None:
+                persist_index(index, paths[i])
+        return indexes
+
+    def __summarize(self, texts, query, model=None, embedding_model=None):
+        """Index each of the texts and summarize them with `query`, reusing
+        cached summaries of texts which have been summarized before."""
+        indexes = self.__index_texts(
+            texts, model=model, embedding_model=embedding_model
+        )
+
+        summary_model = model or DEFAULT_SUMMARY_MODEL
+        keys = [content_hash(query, text) for text in texts]
+        cached = {}
+        if self._cache is not None:
+            cached = self._cache.get_summaries(keys, SUMMARY_PROVIDER, summary_model)
+
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        new_summaries = summarize_indexes([indexes[i] for i in missing], query)
+        if self._cache is not None and missing:
+            self._cache.put_summaries(
+                {keys[i]: summary for i, summary in zip(missing, new_summaries)},
+                SUMMARY_PROVIDER,
+                summary_model,
             )
 
+        summaries = [cached.get(key) for key in keys]
+        for i, summary in zip(missing, new_summaries):
+            summaries[i] = summary
+        return {"summaries": summaries, "indexes": indexes}
+
+    def get_documents(self):
+        """Get a copy of the documents, which is safe to iterate while
+        documents are being indexed, or dropped, in the background."""
+        with self._lock:
+            return dict(self.documents)
+
     def is_empty(self):
         """Returns True if the memory is empty."""
         return not self.documents
@@ -64,14 +241,23 @@ class Memory:
         - <document 2 name>: <document 2 summary>
         ...
         """
-        prompt = ""
-        summaries = [
-            (name, self.document_store[name]["summary"])
-            for name in self.documents.keys()
-        ]
-        for name, summary in summaries:
-            prompt += f"- {name}: {summary}\n"
-        return prompt
+        # The summaries of the initial documents are needed here. If building
+        # them failed, the documents were dropped, and the error is raised
+        # by `wait_until_indexed` instead.
+        self._built.exception()
+        with self._lock:
+            if self._prompt_string is not None:
+                return self._prompt_string
+
+            lines = []
+            for name in self.documents.keys():
+                if name in self.document_store:
+                    summary = self.document_store[name]["summary"]
+                else:
+                    summary = "(Still being indexed; summary not available yet.)"
+                lines.append(f"- {name}: {summary}\n")
+            self._prompt_string = "".join(lines)
+            return self._prompt_string
 
     def get_document(self, name, query="Return the text verbatim.", max_length=5000):
         """Return a document's text verbatim."""
@@ -84,37 +270,175 @@ class Memory:
 
     def add_document(self, name: str, document: str):
         """Add a document to the memory."""
-        self.documents[name] = document
-        llama_doc = Document(text=str(document))
-        summary_obj = summarize_documents([llama_doc], query="Describe the document.")
+        # Wait first, so that the document isn't left without an index if
+        # an earlier one failed to index.
+        self.wait_until_indexed()
+        with self._lock:
+            self.documents[name] = document
+            self._prompt_string = None
+        self.__index_document(name, document)
+
+    def add_document_in_background(self, name: str, document: str):
+        """Add a document to the memory, but summarize and index it in a
+        background thread so that the caller doesn't wait on the LLM and
+        embedding calls. The document's text is available right away; its
+        summary and index are available once indexing finishes."""
+        with self._lock:
+            self.documents[name] = document
+            self._prompt_string = None
+        self._pending.append(
+            self._executor.submit(self.__index_document, name, document)
+        )
+
+    def wait_until_indexed(self):
+        """Block until every document added in the background is indexed.
+        Documents which could not be indexed are dropped from the memory, and
+        an `AgentError` is raised for them once the rest are indexed."""
+        pending, self._pending = self._pending, []
+        errors = []
+        for future in pending:
+            try:
+                future.result()
+            except Exception as exc:
+                errors.append(exc)
+        if errors:
+            raise AgentError(
+                "Could not add some documents to memory: "
+                + "; ".join(str(exc) for exc in errors)
+            )
+
+    def __index_document(self, name: str, document: str):
+        """Summarize and index a document which is already in `documents`."""
+        try:
+            summary_obj = self.__summarize(
+                [document],
+                "Describe the document.",
+                model=self.model,
+                embedding_model=self.embedding_model,
+            )
+        except Exception:
+            self.__drop_documents([name])
+            raise
         summary = summary_obj["summaries"][0]
         index = summary_obj["indexes"][0]
-        self.document_store[name] = {
-            "text": document,
-            "summary": summary,
-            "index": index,
-        }
-        self.router_index.insert(Document(text=str(document)))
+        with self._lock:
+            self._router_pending.append(name)
+            self.document_store[name] = {
+                "text": document,
+                "summary": summary,
+                "index": index,
+            }
+            self._prompt_string = None
+            self._query_cache = {}
 
     def query_all(self, query):
-        """Query and get a response synthesized from all of the docs."""
-        doc_responses = []
-        indexes = [self.document_store[name]["index"] for name in self.documents.keys()]
-        for index in indexes:
-            query_engine = index.as_query_engine(response_mode="tree_summarize")
-            response = query_engine.query(query)
-            text_response = response.response
-            doc_responses.append(text_response)
-
-        list_index = init_index(doc_responses, index_type="list")
-        query_engine = list_index.as_query_engine(response_mode="tree_summarize")
+        """Query every doc concurrently, and synthesize a response from the
+        answers. Docs whose query fails are left out of the synthesis. The
+        queries are sent from a pool of threads rather than an event loop, so
+        that this also works when the caller is already running one."""
+        self.wait_until_indexed()
+        if ("all", query) in self._query_cache:
+            return self._query_cache[("all", query)]
+
+        query_engines = self.__get_doc_query_engines()
+        max_workers = max(1, min(MAX_CONCURRENT_QUERIES, len(query_engines)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(query_engine.query, query)
+                for query_engine in query_engines
+            ]
+            responses = [future.exception() or future.result() for future in futures]
+
+        query_engine = self.__get_answers_query_engine(responses)
         response = query_engine.query(query)
+        return self.__cache_answer(("all", query), response)
+
+    async def aquery_all(self, query):
+        """Async version of `query_all`, for callers running an event loop."""
+        self.wait_until_indexed()
+        if ("all", query) in self._query_cache:
+            return self._query_cache[("all", query)]
+
+        responses = await gather_with_limit(
+            [
+                query_engine.aquery(query)
+                for query_engine in self.__get_doc_query_engines()
+            ],
+            return_exceptions=True,
+        )
+        query_engine = self.__get_answers_query_engine(responses)
+        response = await query_engine.aquery(query)
+        return self.__cache_answer(("all", query), response)
+
+    def __get_doc_query_engines(self):
+        """Get a tree-summarizing query engine for each of the docs."""
+        return [
+            self.document_store[name]["index"].as_query_engine(
+                response_mode="tree_summarize"
+            )
+            for name in self.documents.keys()
+        ]
+
+    def __get_answers_query_engine(self, responses):
+        """Get a query engine which synthesizes a response from the answers
+        of each of the docs, leaving out failed and uninformative ones."""
+        answers = filter_answers(
+            [
+                response.response
+                for response in responses
+                if not isinstance(response, Exception)
+            ]
+        )
+        list_index = init_index(
+            [Document(text=answer) for answer in answers],
+            model=self.model,
+            embedding_model=self.embedding_model,
+            index_type="list",
+        )
+        return list_index.as_query_engine(response_mode="tree_summarize")
+
+    def __cache_answer(self, key, response):
+        """Cache and return the result of a query."""
         context = f"The answer returned from memory is: {response.response}"
-        return {"answer": response.response, "context": context}
+        result = {"answer": response.response, "context": context}
+        self._query_cache[key] = result
+        return result
+
+    def __get_router_index(self):
+        """Get the router index, building it or adding the documents which
+        are pending to it first. It is made of the nodes of the documents'
+        own indexes, which are already embedded."""
+        with self._lock:
+            pending, self._router_pending = self._router_pending, []
+            nodes = [
+                node
+                for name in dict.fromkeys(pending)
+                for node in get_embedded_nodes(self.document_store[name]["index"])
+            ]
+        if self.router_index is None:
+            storage_context = None
+            if self.vector_store_factory is not None:
+                storage_context = StorageContext.from_defaults(
+                    vector_store=self.vector_store_factory()
+                )
+            self.router_index = GPTVectorStoreIndex(
+                nodes,
+                service_context=get_service_context(self.model, self.embedding_model),
+                storage_context=storage_context,
+            )
+        elif nodes:
+            self.router_index.insert_nodes(nodes)
+        return self.router_index
 
     def query_one(self, query):
         """Query and get a response synthesized from one of the docs."""
-        query_engine = self.router_index.as_query_engine()
+        self.wait_until_indexed()
+        if ("one", query) in self._query_cache:
+            return self._query_cache[("one", query)]
+
+        query_engine = self.__get_router_index().as_query_engine()
         response = query_engine.query(query)
         context = f"The answer returned from memory is: {response.response}"
-        return {"answer": response.response, "context": context}
+        result = {"answer": response.response, "context": context}
+        self._query_cache[("one", query)] = result
+        return result
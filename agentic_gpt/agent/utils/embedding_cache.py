@@ -0,0 +1,149 @@
+"""On-disk cache for work done on documents which we don't want to redo
+across runs, such as embedding or summarizing them. Entries are keyed on the SHA-256 hash
+of the content, plus the provider and model which produced them."""
+import os
+import time
+import hashlib
+from array import array
+import sqlite3
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "agentic_gpt", "embedding_cache.sqlite3"
+)
+
+
+def content_hash(*parts):
+    """Hash the given strings into a single hex digest."""
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(str(part).encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class EmbeddingCache:
+    """A SQLite-backed cache. The database is only opened when first used."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def __connect(self):
+        """Open the database and create the table if need be."""
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS embedding_cache (
+                    hash TEXT,
+                    provider TEXT,
+                    model TEXT,
+                    vector BLOB,
+                    summary TEXT,
+                    PRIMARY KEY (hash, provider, model)
+                )"""
+            )
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS completion_cache (
+                    hash TEXT,
+                    provider TEXT,
+                    model TEXT,
+                    completion TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (hash, provider, model)
+                )"""
+            )
+        return self._connection
+
+    def get_summaries(self, hashes, provider, model):
+        """Return a dict of hash => summary for the hashes which are cached."""
+        if not hashes:
+            return {}
+        placeholders = ", ".join("?" * len(hashes))
+        with self._lock:
+            rows = self.__connect().execute(
+                f"""SELECT hash, summary FROM embedding_cache
+                WHERE provider = ? AND model = ? AND summary IS NOT NULL
+                AND hash IN ({placeholders})""",
+                [provider, model, *hashes],
+            )
+            return dict(rows.fetchall())
+
+    def put_summaries(self, summaries, provider, model):
+        """Store a dict of hash => summary."""
+        with self._lock:
+            connection = self.__connect()
+            connection.executemany(
+                """INSERT INTO embedding_cache (hash, provider, model, summary)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (hash, provider, model)
+                DO UPDATE SET summary = excluded.summary""",
+                [(key, provider, model, summary) for key, summary in summaries.items()],
+            )
+            connection.commit()
+
+    def get_vectors(self, hashes, provider, model):
+        """Return a dict of hash => embedding for the hashes which are cached."""
+        if not hashes:
+            return {}
+        placeholders = ", ".join("?" * len(hashes))
+        with self._lock:
+            rows = self.__connect().execute(
+                f"""SELECT hash, vector FROM embedding_cache
+                WHERE provider = ? AND model = ? AND vector IS NOT NULL
+                AND hash IN ({placeholders})""",
+                [provider, model, *hashes],
+            )
+            return {key: array("f", blob).tolist() for key, blob in rows.fetchall()}
+
+    def put_vectors(self, vectors, provider, model):
+        """Store a dict of hash => embedding. Embeddings are stored as 32-bit
+        floats."""
+        with self._lock:
+            connection = self.__connect()
+            connection.executemany(
+                """INSERT INTO embedding_cache (hash, provider, model, vector)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (hash, provider, model)
+                DO UPDATE SET vector = excluded.vector""",
+                [
+                    (key, provider, model, array("f", vector).tobytes())
+                    for key, vector in vectors.items()
+                ],
+            )
+            connection.commit()
+
+    def get_completion(self, key, provider, model, ttl=None):
+        """Return the cached completion of the prompt hashed to `key`, or None
+        if there is none or it is older than `ttl` seconds."""
+        with self._lock:
+            row = self.__connect().execute(
+                """SELECT completion, created_at FROM completion_cache
+                WHERE hash = ? AND provider = ? AND model = ?""",
+                [key, provider, model],
+            ).fetchone()
+        if row is None:
+            return None
+        completion, created_at = row
+        if ttl is not None and time.time() - created_at > ttl:
+            return None
+        return completion
+
+    def put_completion(self, key, provider, model, completion):
+        """Store the completion of the prompt hashed to `key`."""
+        with self._lock:
+            connection = self.__connect()
+            connection.execute(
+                """INSERT INTO completion_cache
+                (hash, provider, model, completion, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (hash, provider, model)
+                DO UPDATE SET completion = excluded.completion,
+                created_at = excluded.created_at""",
+                [key, provider, model, completion, time.time()],
+            )
+            connection.commit()
@@ -1,30 +1,73 @@
 """Helper functions for Llama Index."""
+import math
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from llama_index import GPTVectorStoreIndex, GPTListIndex
 from llama_index import ServiceContext, LLMPredictor
 from llama_index import LangchainEmbedding, Document
+from llama_index import StorageContext, load_index_from_storage
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.embeddings.openai import OpenAIEmbedding
 from langchain.chat_models import ChatOpenAI
 from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+from .embedding_cache import EmbeddingCache, content_hash, DEFAULT_CACHE_PATH
 
 CHATGPT_KWARGS = {"temperature": 0, "model_name": "gpt-3.5-turbo"}
 
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
 
-def init_index(docs, model="gpt-3.5-turbo", embedding_model=None, index_type="vector"):
-    """Initialize each index with a different service context."""
-    assert index_type in ("vector", "list")
+DEFAULT_SUMMARY_QUERY = "Summarize in a few sentences."
+
+# Number of texts sent to the OpenAI embeddings endpoint per request.
+EMBED_BATCH_SIZE = 100
+
+# Number of texts the sentence-transformers model encodes at a time.
+HF_ENCODE_BATCH_SIZE = 64
+
+# Number of query embeddings kept in memory by each `CachedEmbedding`.
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+
+# Maximum number of queries sent to the LLM at the same time, to stay within
+# the provider's concurrent request limits.
+MAX_CONCURRENT_QUERIES = 10
+
+
+def get_service_context(model="gpt-3.5-turbo", embedding_model=None):
+    """Get a service context with the given language and embedding models.
+    Contexts are built once per pair of models and then shared, so that
+    their clients are reused across calls."""
+    return _get_service_context(
+        model or CHATGPT_KWARGS["model_name"],
+        embedding_model or DEFAULT_EMBEDDING_MODEL,
+    )
 
-    kwargs = CHATGPT_KWARGS
-    kwargs["model_name"] = model
 
+@lru_cache(maxsize=8)
+def _get_service_context(model, embedding_model):
+    kwargs = dict(CHATGPT_KWARGS, model_name=model)
     llm = LLMPredictor(llm=ChatOpenAI(**kwargs))
+    return ServiceContext.from_defaults(
+        llm_predictor=llm, embed_model=get_embed_model(embedding_model)
+    )
 
-    if embedding_model is None or embedding_model == "text-embedding-ada-002":
-        service_context = ServiceContext.from_defaults(llm_predictor=llm)
-    elif embedding_model == "sentencetransformers":
-        embed_model = LangchainEmbedding(HuggingFaceEmbeddings())
-        service_context = ServiceContext.from_defaults(
-            llm_predictor=llm,
-            embed_model=embed_model,
-        )
+
+def init_index(
+    docs,
+    model="gpt-3.5-turbo",
+    embedding_model=None,
+    index_type="vector",
+    service_context=None,
+):
+    """Initialize an index over `docs`. A `service_context` can be passed in
+    to share it between indexes; otherwise, one is created from `model` and
+    `embedding_model`."""
+    assert index_type in ("vector", "list")
+
+    if service_context is None:
+        service_context = get_service_context(model, embedding_model)
 
     if index_type == "vector":
         index = GPTVectorStoreIndex.from_documents(
@@ -36,6 +79,29 @@ def init_index(docs, model="gpt-3.5-turbo", embedding_model=None, index_type="ve
     return index
 
 
+def get_embedded_nodes(index):
+    """Get the nodes of a vector index along with their embeddings, so that
+    they can be added to another index without being embedded again."""
+    nodes = []
+    for node_id, node in index.docstore.docs.items():
+        node.embedding = index.vector_store.get(node_id)
+        nodes.append(node)
+    return nodes
+
+
+def persist_index(index, persist_dir):
+    """Save an index to `persist_dir`."""
+    index.storage_context.persist(persist_dir=persist_dir)
+
+
+def load_index(persist_dir, model="gpt-3.5-turbo", embedding_model=None):
+    """Load an index which was saved with `persist_index`."""
+    storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+    return load_index_from_storage(
+        storage_context, service_context=get_service_context(model, embedding_model)
+    )
+
+
 def retrieve_segment_of_text(query, text, model=None, embedding_model=None):
     """Retrieves a segment of text given a query and a text."""
     index = init_index(
@@ -47,21 +113,170 @@ def retrieve_segment_of_text(query, text, model=None, embedding_model=None):
     return source
 
 
-def summarize_documents(docs, query="Summarize in a few sentences.", model=None, embedding_model=None):
-    """Given a list of documents, create a list of their summaries."""
-    if model is None:
-        model = "gpt-3.5-turbo"
-    if embedding_model is None:
-        embedding_model = "text-embedding-ada-002"
+def summarize_documents(docs, query=DEFAULT_SUMMARY_QUERY, model=None, embedding_model=None):
+    """Given a list of documents, create a list of their summaries, along
+    with the index of each document."""
+    indexes = index_documents(docs, model=model, embedding_model=embedding_model)
+    summaries = summarize_indexes(indexes, query)
+    return {"summaries": summaries, "indexes": indexes}
+
+
+def index_documents(docs, model=None, embedding_model=None):
+    """Create a vector index for each of the documents."""
+    service_context = get_service_context(model, embedding_model)
+
+    # Chunk every document first, so that the chunks of all of them can be
+    # embedded together in as few requests as possible.
+    node_parser = service_context.node_parser
+    nodes_per_doc = [node_parser.get_nodes_from_documents([doc]) for doc in docs]
+    nodes = [node for doc_nodes in nodes_per_doc for node in doc_nodes]
+    embeddings = embed_texts(
+        service_context.embed_model, [node.get_text() for node in nodes]
+    )
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+
+    # The index doesn't embed nodes which already have an embedding.
+    return [
+        GPTVectorStoreIndex(doc_nodes, service_context=service_context)
+        for doc_nodes in nodes_per_doc
+    ]
+
 
-    summaries = []
-    indexes = []
-    for doc in docs:
-        index = init_index(
-            [doc], index_type="vector", model=model, embedding_model=embedding_model
+def embed_texts(embed_model, texts):
+    """Embed the texts in batches of `EMBED_BATCH_SIZE`."""
+    embeddings = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        embeddings.extend(
+            embed_model._get_text_embeddings(texts[i : i + EMBED_BATCH_SIZE])
         )
-        query_engine = index.as_query_engine(response_mode="tree_summarize")
-        response = query_engine.query(query)
-        summaries.append(response.response)
-        indexes.append(index)
-    return {"summaries": summaries, "indexes": indexes}
+    return embeddings
+
+
+def summarize_indexes(indexes, query=DEFAULT_SUMMARY_QUERY):
+    """Summarize each of the indexes. The summary queries are sent from a
+    pool of threads rather than one after the other, which also works when
+    the caller is already running an event loop."""
+    if not indexes:
+        return []
+    max_workers = min(MAX_CONCURRENT_QUERIES, len(indexes))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_summarize_index, index, query) for index in indexes
+        ]
+        return [future.result() for future in futures]
+
+
+def _summarize_index(index, query):
+    """Query an index with tree summarization and return the text response."""
+    query_engine = index.as_query_engine(response_mode="tree_summarize")
+    return query_engine.query(query).response
+
+
+async def gather_with_limit(
+    coroutines, limit=MAX_CONCURRENT_QUERIES, return_exceptions=False
+):
+    """Like `asyncio.gather`, but runs at most `limit` of the coroutines at
+    the same time."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(
+        *[run(coroutine) for coroutine in coroutines],
+        return_exceptions=return_exceptions,
+    )
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embedding model so that the embeddings of texts are cached on
+    disk, keyed on a hash of the text, and texts embedded in an earlier run
+    aren't sent to the model again. Embeddings of recent queries are kept in
+    memory, since agents often ask the same question again when retrying."""
+
+    def __init__(self, embed_model, cache, provider, model):
+        super().__init__(embed_batch_size=embed_model.embed_batch_size)
+        self.embed_model = embed_model
+        self.cache = cache
+        self.provider = provider
+        self.model = model
+        # Least recently used first. The model is shared by every thread in
+        # the process, so the cache is guarded by a lock.
+        self._query_embeddings = OrderedDict()
+        self._query_embeddings_lock = threading.Lock()
+
+    def _get_query_embedding(self, query):
+        with self._query_embeddings_lock:
+            embedding = self._query_embeddings.get(query)
+            if embedding is not None:
+                self._query_embeddings.move_to_end(query)
+                return embedding
+        embedding = self.embed_model.get_query_embedding(query)
+        with self._query_embeddings_lock:
+            self._query_embeddings[query] = embedding
+            if len(self._query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_embeddings.popitem(last=False)
+        return embedding
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        keys = [content_hash(text) for text in texts]
+        vectors = self.cache.get_vectors(keys, self.provider, self.model)
+        missing = [i for i, key in enumerate(keys) if key not in vectors]
+        if missing:
+            new_vectors = self.embed_model._get_text_embeddings(
+                [texts[i] for i in missing]
+            )
+            new_vectors = {keys[i]: vector for i, vector in zip(missing, new_vectors)}
+            self.cache.put_vectors(new_vectors, self.provider, self.model)
+            vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+
+def get_huggingface_embeddings():
+    """Load the sentence-transformers model. On a GPU, its weights are cast
+    to half precision, which roughly doubles its throughput; embeddings are
+    still returned as 32-bit floats."""
+    import torch
+
+    embeddings = HuggingFaceEmbeddings(
+        encode_kwargs={"batch_size": HF_ENCODE_BATCH_SIZE}
+    )
+    if torch.cuda.is_available():
+        embeddings.client.half()
+    return embeddings
+
+
+def get_embed_model(embedding_model=None, cache_path=DEFAULT_CACHE_PATH):
+    """Get an embedding model by name. Models are loaded once per process
+    and kept warm for every later caller. Text embeddings are cached on disk
+    at `cache_path`; pass None to disable it."""
+    return _get_embed_model(embedding_model or DEFAULT_EMBEDDING_MODEL, cache_path)
+
+
+@lru_cache(maxsize=None)
+def _get_embed_model(embedding_model, cache_path):
+    if embedding_model == DEFAULT_EMBEDDING_MODEL:
+        embed_model = OpenAIEmbedding(embed_batch_size=EMBED_BATCH_SIZE)
+        provider, model = "openai", "text-embedding-ada-002"
+    elif embedding_model == "sentencetransformers":
+        embed_model = LangchainEmbedding(get_huggingface_embeddings())
+        provider, model = "huggingface", "sentencetransformers"
+
+    if cache_path is None:
+        return embed_model
+    return CachedEmbedding(embed_model, EmbeddingCache(cache_path), provider, model)
+
+
+def cosine_similarity(embedding1, embedding2):
+    """Cosine similarity between two embeddings."""
+    dot = sum(a * b for a, b in zip(embedding1, embedding2))
+    norm1 = math.sqrt(sum(a * a for a in embedding1))
+    norm2 = math.sqrt(sum(b * b for b in embedding2))
+    if not norm1 or not norm2:
+        return 0.0
+    return dot / (norm1 * norm2)
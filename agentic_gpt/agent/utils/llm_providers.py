@@ -1,6 +1,12 @@
 """OpenAI utils."""
 import time
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
 import openai
+from .parsing import JsonObjectTracker
+from .indexing import get_embed_model
 
 # This obviously should depend on the tokenizer used but we don't have access
 # to that, so we just use a heuristic. Note that this does not mean the context
@@ -20,59 +26,316 @@ OPENAI_MODELS = {
 
 SUPPORTED_LANGUAGE_MODELS = OPENAI_MODELS
 
+# Name of the function the model is made to call when a JSON schema is given.
+JSON_RESPONSE_FUNCTION = "respond"
 
-def get_completion(
-    prompt, model="gpt-3.5-turbo", temperature=0, max_tokens=4000, stop=["```"]
-):
+# Completions of prompts sampled at temperature 0, keyed on the prompt and the
+# settings it was sent with. Such a prompt would get the same completion anyway.
+# Least recently used first.
+COMPLETION_CACHE = OrderedDict()
+COMPLETION_CACHE_MAX_SIZE = 1024
+
+# A prompt reuses the completion of the most similar prompt in the semantic
+# cache which was sent with the same settings, if their embeddings are at least
+# this similar.
+SEMANTIC_CACHE_MAX_SIZE = 256
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+_cache_lock = threading.Lock()
+
+
+class SemanticCache:
+    """Completions which callers can opt into reusing for prompts that are
+    merely similar. The prompt embeddings are normalized and kept as the rows
+    of one matrix, so that comparing a prompt to all of them is a single
+    matrix-vector product."""
+
+    def __init__(self, max_size=SEMANTIC_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.settings = []
+        self.completions = []
+        self.embeddings = None
+
+    def get(self, settings, embedding, threshold=SEMANTIC_CACHE_THRESHOLD):
+        """Get the completion of the most similar prompt sent with the same
+        `settings`, or None if none is similar enough."""
+        if self.embeddings is None:
+            return None
+        similarities = self.embeddings @ _normalize(embedding)
+        same_settings = np.array([entry == settings for entry in self.settings])
+        similarities[~same_settings] = -1
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        return self.completions[best]
+
+    def put(self, settings, embedding, completion):
+        """Add a completion, evicting the oldest one if the cache is full."""
+        row = _normalize(embedding)[np.newaxis, :]
+        start = max(0, len(self.completions) + 1 - self.max_size)
+        if self.embeddings is None:
+            self.embeddings = row
+        else:
+            self.embeddings = np.vstack([self.embeddings[start:], row])
+        self.settings = self.settings[start:] + [settings]
+        self.completions = self.completions[start:] + [completion]
+
+
+def _normalize(embedding):
+    """Scale an embedding to unit length, as 32-bit floats."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+SEMANTIC_CACHE = SemanticCache()
+
+# Errors from OpenAI's API which are worth retrying, and how often and how
+# long to back off for.
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+)
+MAX_RETRIES = 8
+MAX_RETRY_DELAY = 60
+
+
+def get_messages(prompt, system=None):
+    """Get the chat messages for a prompt. A `system` prompt which is the same
+    across calls is sent as its own leading message, so that the provider can
+    reuse its prompt cache for it."""
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    return messages
+
+
+def check_model(model):
+    """Check that `model` is one we support."""
     supported_models = list(SUPPORTED_LANGUAGE_MODELS.keys())
     assert (
         model in supported_models
     ), f"Model {model} not supported. Supported models: {supported_models}"
 
+
+def get_completion(
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0,
+    max_tokens=4000,
+    stop=["```"],
+    system=None,
+    disable_cache=False,
+    semantic_cache=False,
+    on_delta=None,
+):
+    """Get a completion of `prompt`. Completions at temperature 0 are cached
+    unless `disable_cache` is set. If `semantic_cache` is set, the completion
+    of a sufficiently similar earlier prompt is reused as well. If `on_delta`
+    is given, the completion is streamed and `on_delta` is called with each
+    new piece of text as it arrives (or once with the whole completion if it
+    was cached)."""
+    check_model(model)
+
+    use_cache = not disable_cache and temperature == 0
+    settings = (model, system, temperature, max_tokens, tuple(stop or ()))
+    key = settings + (prompt,)
+    embedding = None
+    text = None
+    if use_cache:
+        with _cache_lock:
+            text = COMPLETION_CACHE.get(key)
+            if text is not None:
+                COMPLETION_CACHE.move_to_end(key)
+        if text is None and semantic_cache:
+            embedding = get_embed_model().get_query_embedding(prompt)
+            with _cache_lock:
+                text = SEMANTIC_CACHE.get(settings, embedding)
+        if text is not None:
+            if on_delta is not None:
+                on_delta(text)
+            return text
+
     if model in OPENAI_MODELS:
+        text = openai_call(
+            prompt,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stop=stop,
+            system=system,
+            on_delta=on_delta,
+        )
+        if isinstance(text, dict):
+            return text
+
+    if use_cache:
+        with _cache_lock:
+            COMPLETION_CACHE[key] = text
+            if len(COMPLETION_CACHE) > COMPLETION_CACHE_MAX_SIZE:
+                COMPLETION_CACHE.popitem(last=False)
+            if embedding is not None:
+                SEMANTIC_CACHE.put(settings, embedding, text)
+    return text
+
+
+def get_retry_delay(exc, attempt):
+    """Get how many seconds to wait before retrying after `exc`. The API's
+    Retry-After header is used if it sent one; otherwise the delay backs off
+    exponentially, with jitter so that concurrent callers don't retry in
+    lockstep."""
+    headers = getattr(exc, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
         try:
-            return openai_call(
-                prompt,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stop=stop,
+            return min(MAX_RETRY_DELAY, float(retry_after))
+        except ValueError:
+            pass
+    return min(MAX_RETRY_DELAY, 0.5 * 2**attempt) + random.uniform(0, 0.5)
+
+
+def create_with_retries(read, prompt, system=None, can_retry=None, **kwargs):
+    """Create a chat completion of `prompt` with `kwargs` and return what
+    `read` makes of the response. If the API fails in a way worth retrying,
+    whether creating the completion or while `read` streams it, both are
+    retried with backoff, unless `can_retry` says otherwise. A request which
+    the API rejects is returned as an error instead."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = openai.ChatCompletion.create(
+                messages=get_messages(prompt, system),
+                top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0,
+                **kwargs,
             )
+            return read(response)
         except openai.error.InvalidRequestError as exc:
             return {"error": str(exc)}
+        except RETRYABLE_ERRORS as exc:
+            if attempt == MAX_RETRIES - 1 or (can_retry and not can_retry()):
+                raise
+            delay = get_retry_delay(exc, attempt)
+            print(exc)
+            print(f"Error from OpenAI's API. Retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
 
 
 def openai_call(
-    prompt, model="gpt-3.5-turbo", temperature=0, max_tokens=1024, stop=["```"]
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0,
+    max_tokens=1024,
+    stop=["```"],
+    system=None,
+    on_delta=None,
 ):
-    """Wrapper over OpenAI's completion API."""
-    try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=max_tokens,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            temperature=temperature,
-            stop=stop,
-        )
-        text = response["choices"][0]["message"]["content"]
-    except (
-        openai.error.RateLimitError,
-        openai.error.APIError,
-        openai.error.Timeout,
-        openai.error.APIConnectionError,
-    ) as exc:
-        print(exc)
-        print("Error from OpenAI's API. Sleeping for a few seconds.")
-        time.sleep(5)
-        text = openai_call( 
+    """Wrapper over OpenAI's completion API. If `on_delta` is given, the
+    completion is streamed and `on_delta` is called with each piece of it.
+    A streamed completion is not retried once any of it has been passed to
+    `on_delta`, since the callback would be sent the same text again."""
+    chunks = []
+
+    def read(response):
+        if on_delta is None:
+            return response["choices"][0]["message"]["content"]
+        for chunk in response:
+            delta = chunk["choices"][0]["delta"].get("content", "")
+            if delta:
+                chunks.append(delta)
+                on_delta(delta)
+        return "".join(chunks)
+
+    return create_with_retries(
+        read,
+        prompt,
+        system=system,
+        can_retry=lambda: not chunks,
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stop=stop,
+        stream=on_delta is not None,
+    )
+
+
+def get_json_completion(
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0,
+    max_tokens=4000,
+    stop=["```"],
+    json_schema=None,
+    system=None,
+):
+    """Like `get_completion`, but for prompts that are answered with a JSON
+    object. The completion is streamed and returned as soon as the top-level
+    object is closed, so we don't wait on any trailing tokens. If a
+    `json_schema` is given, the model is made to answer by calling a function
+    with parameters of that schema."""
+    check_model(model)
+
+    if model in OPENAI_MODELS:
+        return openai_json_call(
             prompt,
             model=model,
             temperature=temperature,
             max_tokens=max_tokens,
             stop=stop,
+            json_schema=json_schema,
+            system=system,
         )
 
-    return text
+
+def openai_json_call(
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0,
+    max_tokens=1024,
+    stop=["```"],
+    json_schema=None,
+    system=None,
+):
+    """Wrapper over OpenAI's streaming completion API which stops reading
+    once a complete JSON object has been received."""
+    kwargs = {}
+    if json_schema is not None:
+        kwargs["functions"] = [
+            {
+                "name": JSON_RESPONSE_FUNCTION,
+                "description": "Respond with your answer.",
+                "parameters": json_schema,
+            }
+        ]
+        kwargs["function_call"] = {"name": JSON_RESPONSE_FUNCTION}
+
+    def read(response):
+        tracker = JsonObjectTracker()
+        chunks = []
+        for chunk in response:
+            delta = chunk["choices"][0]["delta"]
+            if "function_call" in delta:
+                delta = delta["function_call"].get("arguments", "")
+            else:
+                delta = delta.get("content", "")
+            end = tracker.feed(delta)
+            if end is not None:
+                chunks.append(delta[:end])
+                response.close()
+                break
+            chunks.append(delta)
+        return "".join(chunks)
+
+    return create_with_retries(
+        read,
+        prompt,
+        system=system,
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stop=stop,
+        stream=True,
+        **kwargs,
+    )
@@ -0,0 +1,86 @@
+"""Helpers for parsing the JSON that the language model returns."""
+
+
+class JsonObjectTracker:
+    """Tracks the brace depth of text as it streams in, ignoring braces
+    inside of strings, so that we know when the first top-level JSON object
+    has been closed."""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text):
+        """Feed the next piece of text. Returns the index in `text` just past
+        the brace that closes the top-level object, or None if the object has
+        not been closed yet."""
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.started
+            elif char == "{":
+                self.depth += 1
+                self.started = True
+            elif char == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return None
+
+
+def repair_json(text):
+    """Make a best effort at turning a slightly malformed JSON object, as
+    language models sometimes return, into valid JSON. Text around the
+    object is dropped, trailing commas are removed, and raw newlines inside
+    of strings are escaped. An object which was never closed, e.g., because
+    the completion was cut short, is returned as is rather than completed,
+    so that a truncated command is never taken. Whether the result is valid
+    is left to the caller's parser."""
+    start = text.find("{")
+    if start == -1:
+        return text
+    text = text[start:]
+    end = JsonObjectTracker().feed(text)
+    if end is None:
+        return text
+    text = text[:end]
+
+    chars = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            elif char == "\n":
+                char = "\\n"
+            chars.append(char)
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in "}]":
+            _drop_trailing_comma(chars)
+        chars.append(char)
+    return "".join(chars)
+
+
+def _drop_trailing_comma(chars):
+    """Remove a comma, and any whitespace after it, from the end of `chars`."""
+    i = len(chars)
+    while i and chars[i - 1].isspace():
+        i -= 1
+    if i and chars[i - 1] == ",":
+        del chars[i - 1 :]
@@ -27,9 +27,37 @@ def get_current_browser_view_from_mapping(mapping):
     return elements
 
 
-def get_tag_name(locator):
-    """Get the tag name from a locator."""
-    return locator.evaluate("(element) => element.tagName").lower()
+# Attributes of an element which are shown to the AI. Inputs also show their
+# value and placeholder.
+ATTRS_TO_KEEP = ["alt", "aria-label", "name", "title", "type", "role"]
+INPUT_ATTRS_TO_KEEP = ["value", "placeholder"]
+
+# Describes an element in a single round trip to the browser, rather than one
+# per property.
+DESCRIBE_ELEMENT_JS = """(element, attrNames) => {
+    const attrs = {};
+    for (const name of attrNames) {
+        const value = element.getAttribute(name);
+        if (value) {
+            attrs[name] = value;
+        }
+    }
+    const rect = element.getBoundingClientRect();
+    const style = window.getComputedStyle(element);
+    return {
+        tagName: element.tagName.toLowerCase(),
+        outerHTML: element.outerHTML,
+        innerText: element.innerText || "",
+        visible: rect.width > 0 && rect.height > 0 && style.visibility !== "hidden",
+        attrs: attrs,
+    };
+}"""
+
+
+def describe_element(locator):
+    """Get the tag name, outer HTML, inner text, visibility and attributes of
+    the element behind a locator."""
+    return locator.evaluate(DESCRIBE_ELEMENT_JS, ATTRS_TO_KEEP + INPUT_ATTRS_TO_KEEP)
 
 
 def wait(seconds):
@@ -37,11 +65,6 @@ def wait(seconds):
     time.sleep(seconds)
 
 
-def get_outer_html(locator):
-    """Get the outer HTML from a locator."""
-    return locator.evaluate("(element) => element.outerHTML")
-
-
 class PlaywrightAgent(AgenticGPT):
     def __init__(
         self,
@@ -195,10 +218,7 @@ class PlaywrightAgent(AgenticGPT):
         anchors = self.page.locator("a").all()
         buttons = self.page.locator("button").all()
         imgs = self.page.locator("img").all()
-        divs = self.page.locator("div").all()
-        divs = [
-            div for div in divs if div.get_attribute("role") in ["button", "textbox"]
-        ]
+        divs = self.page.locator('div[role="button"], div[role="textbox"]').all()
 
         # Combine all of the elements.
         elements = inputs + textareas + anchors + buttons + imgs + divs
@@ -206,40 +226,27 @@ class PlaywrightAgent(AgenticGPT):
         mapping = {}
         curr_idx = 1
         for element in elements:
-            tag_name = get_tag_name(element)
+            description = describe_element(element)
+            tag_name = description["tagName"]
 
             # If the element is not visible, then don't include it.
-            if not element.is_visible():
+            if not description["visible"]:
                 continue
-            old_element = get_outer_html(element)
-
-            # Select the attributes to keep.
-            attrs = {}
-            attrs_to_keep = [
-                "alt",
-                "aria-label",
-                "name",
-                "title",
-                "type",
-                "role",
-            ]
-            for attr in attrs_to_keep:
-                if element.get_attribute(attr):
-                    attrs[attr] = str(element.get_attribute(attr))
-
-            # If the element is an input, then add the value and the
-            # placeholder.
+            old_element = description["outerHTML"]
 
+            # Select the attributes to keep. If the element is an input, then
+            # add the value and the placeholder.
+            attrs_to_keep = ATTRS_TO_KEEP
             if tag_name == "input":
-                input_value = str(element.get_attribute("value"))
-                input_placeholder = str(element.get_attribute("placeholder"))
-                if input_value:
-                    attrs["value"] = input_value
-                if input_placeholder:
-                    attrs["placeholder"] = input_placeholder
+                attrs_to_keep = ATTRS_TO_KEEP + INPUT_ATTRS_TO_KEEP
+            attrs = {
+                attr: description["attrs"][attr]
+                for attr in attrs_to_keep
+                if attr in description["attrs"]
+            }
 
             # Get the text from the element and strip whitespace.
-            text = element.inner_text().replace("\n", " ")
+            text = description["innerText"].replace("\n", " ")
 
             # Create the new element.
             bs_tag = Tag(name=tag_name, attrs=attrs)
@@ -249,7 +256,7 @@ class PlaywrightAgent(AgenticGPT):
 
             # If the img has no alt text, then don't include it.
             # In the future, we could try to use computer vision to caption.
-            if tag_name == "img" and not element.get_attribute("alt"):
+            if tag_name == "img" and "alt" not in attrs:
                 continue
 
             # If div, button, or anchor has no text, then don't include it.
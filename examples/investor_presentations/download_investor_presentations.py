@@ -1,139 +1,501 @@
 """Use AgenticGPT to download investor presentations."""
+import os
+import re
+import time
+import atexit
+import shelve
+import asyncio
 import datetime
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
 from urllib.parse import urlparse
-from bs4 import BeautifulSoup
 
 load_dotenv()
 from agentic_gpt.agent import AgenticGPT
 from agentic_gpt.agent.utils.llm_providers import get_completion
+from agentic_gpt.agent.utils.embedding_cache import EmbeddingCache, content_hash
 from agentic_gpt.agent.action import Action
-from playwright.sync_api import sync_playwright
 
+# Playwright, BeautifulSoup and requests are slow to import, so they are only
+# imported by the functions which use them.
+
+
+# Maximum number of pages scraped at the same time.
+MAX_CONCURRENT_PAGES = 5
+
+# Maximum number of PDFs downloaded at the same time.
+MAX_CONCURRENT_DOWNLOADS = 8
+
+# PDFs are written to disk in chunks of this many bytes as they arrive, rather
+# than held in memory whole. They are already compressed, so they are asked for
+# without gzip.
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+DOWNLOAD_HEADERS = {"Accept-Encoding": "identity"}
+
+# The model is shown at most this many urls to choose from: the ones which look
+# most relevant, plus the shortest of the rest. The smaller model is used when
+# the list is short enough to fit its context window. The answer is a single
+# url, so few tokens are needed for it.
+MAX_RELEVANT_URLS = 40
+MAX_OTHER_URLS = 10
+RELEVANT_URL_RE = re.compile(
+    r"investor|\bir\b|event|presentation|earnings|quarterly|results", re.IGNORECASE
+)
+CHOOSE_URL_MODEL = "gpt-3.5-turbo-16k"
+CHOOSE_URL_SHORT_MODEL = "gpt-3.5-turbo"
+CHOOSE_URL_MAX_TOKENS = 256
+
+# If AGENTIC_GPT_LLM_CACHE=1, the model's choices of url are cached on disk
+# for a day, so that running the example again for the same company doesn't
+# ask the model the same questions again.
+CHOOSE_URL_CACHE_TTL = 24 * 60 * 60
+_CHOOSE_URL_CACHE = (
+    EmbeddingCache() if os.environ.get("AGENTIC_GPT_LLM_CACHE") == "1" else None
+)
+
+# Companies rarely change their websites, so the website found for a ticker
+# is kept on disk for a month.
+WEBSITE_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "agentic_gpt", "company_websites"
+)
+WEBSITE_CACHE_TTL = 30 * 24 * 60 * 60
+_website_cache_lock = threading.Lock()
+
+# Downloads to the same path are made one at a time, so that they never
+# write the same file at once.
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
+# How long to wait, in milliseconds, for a page's HTML to load and then for
+# its first link to be attached. Waiting for the network to go idle instead
+# can take tens of seconds on pages with analytics beacons.
+PAGE_LOAD_TIMEOUT = 15000
+LINK_WAIT_TIMEOUT = 5000
+
+# Pages with fewer links than this in their HTML, or with any of these markers
+# of a page rendered by JavaScript, are rendered in the browser instead.
+MIN_STATIC_LINKS = 5
+SPA_MARKERS = ["window.__NEXT_DATA__", "data-reactroot", "ng-version"]
+
+BROWSER_ARGS = [
+    "--disable-dev-shm-usage",
+    "--disable-background-networking",
+    "--disable-renderer-backgrounding",
+    "--disable-features=Translate,MediaRouter",
+]
+
+# Only the links on a page are read, so requests for these kinds of
+# resources are aborted rather than downloaded and rendered.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet"}
+
+# One browser is launched the first time a page is scraped and kept open for
+# the rest of the process. It belongs to an event loop which runs in its own
+# thread, so that every call can reuse it.
+_LOOP = None
+_PLAYWRIGHT = None
+_BROWSER = None
+_BROWSER_LAUNCH_LOCK = None
+_loop_lock = threading.Lock()
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
 }
 
 
+@lru_cache(maxsize=1)
+def _get_session():
+    """Get the session shared by every request, so that connections to the
+    same site are kept alive and reused, and transient errors are retried."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        ),
+    )
+    return session
+
+
+@lru_cache(maxsize=4096)
 def _get_domain_of_url(url):
-    """From https://www.example.com, get example.com."""
+    """From https://www.example.com, get example.com. Memoized, since it is
+    called for every link on a page and pages repeat the same hosts."""
     netloc = urlparse(url).netloc
     return ".".join(netloc.split(".")[-2:])
 
 
+@lru_cache(maxsize=1024)
 def get_company_website(ticker):
+    """Visits Yahoo! Finance to get the company website, unless it was
+    found within the last `WEBSITE_CACHE_TTL` seconds."""
+    os.makedirs(os.path.dirname(WEBSITE_CACHE_PATH), exist_ok=True)
+    with _website_cache_lock, shelve.open(WEBSITE_CACHE_PATH) as cache:
+        entry = cache.get(ticker)
+    if entry is not None and time.time() - entry["created_at"] < WEBSITE_CACHE_TTL:
+        return entry["website"]
+
+    website = _get_company_website_from_yahoo(ticker)
+    with _website_cache_lock, shelve.open(WEBSITE_CACHE_PATH) as cache:
+        cache[ticker] = {"website": website, "created_at": time.time()}
+    return website
+
+
+def _get_company_website_from_yahoo(ticker):
     """Visits Yahoo! Finance to get the company website."""
+    from bs4 import BeautifulSoup, SoupStrainer
+
     url = f"https://finance.yahoo.com/quote/{ticker}/profile?p={ticker}"
-    resp = requests.get(url, headers=HEADERS)
-    soup = BeautifulSoup(resp.text, "html.parser")
-    profile = soup.find("div", {"class": "asset-profile-container"})
-    return profile.findAll("a")[-1]["href"]
+    resp = _get_session().get(url, headers=HEADERS)
+    # Only parse the profile into a tree, since nothing else on the page is read.
+    strainer = SoupStrainer("div", {"class": "asset-profile-container"})
+    soup = BeautifulSoup(resp.text, "lxml", parse_only=strainer)
+    return soup.find_all("a")[-1]["href"]
+
+
+def _is_pdf_link(href):
+    """Whether a link points to a PDF, whatever the case of its extension."""
+    return href.lower().endswith(".pdf")
+
+
+def _get_relevant_links(url, hrefs, pdf_only=False):
+    """Of the hrefs found on a url, keep the ones that link back to its own
+    domain and the ones that link to PDFs, or only the latter if `pdf_only`."""
+    original_domain = _get_domain_of_url(url)
+    relevant_links = []
+    append = relevant_links.append
+    for href in hrefs:
+        # Cheapest checks first; the domain is only parsed if they fail.
+        if _is_pdf_link(href):
+            append(href)
+        elif pdf_only:
+            continue
+        elif href.startswith("/") or _get_domain_of_url(href) == original_domain:
+            append(href)
+    return relevant_links
+
+
+def _get_static_hrefs(url):
+    """Get the hrefs of a url from its HTML alone, without rendering it.
+    Returns None if the page seems to need JavaScript to render its links,
+    or couldn't be fetched, in which case a browser has to be used."""
+    import requests
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    try:
+        resp = _get_session().get(url, headers=HEADERS, timeout=10)
+        resp.raise_for_status()
+    except requests.RequestException:
+        return None
+    if any(marker in resp.text for marker in SPA_MARKERS):
+        return None
+    soup = BeautifulSoup(
+        resp.text, "lxml", parse_only=SoupStrainer("a", href=True)
+    )
+    hrefs = [a["href"] for a in soup.find_all("a") if a["href"]]
+    if len(hrefs) < MIN_STATIC_LINKS:
+        return None
+    return hrefs
+
+
+async def _block_unneeded_resources(route):
+    """Abort requests for resources which links can't be read from."""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def _get_hrefs_from_page(browser, url, semaphore):
+    """Visits a url in a new browser context and grabs the hrefs of all of
+    its links."""
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+    async with semaphore:
+        context = await browser.new_context()
+        try:
+            await context.route("**/*", _block_unneeded_resources)
+            page = await context.new_page()
+            await page.goto(
+                url, wait_until="domcontentloaded", timeout=PAGE_LOAD_TIMEOUT
+            )
+            try:
+                await page.wait_for_selector(
+                    "a", state="attached", timeout=LINK_WAIT_TIMEOUT
+                )
+            except PlaywrightTimeoutError:
+                pass  # The page has no links; return none.
+            # Read every href in one call to the browser rather than one per link.
+            return await page.eval_on_selector_all(
+                "a", "links => links.map(link => link.getAttribute('href')).filter(Boolean)"
+            )
+        finally:
+            await context.close()
+
+
+def _run_in_browser_loop(coroutine):
+    """Run a coroutine on the event loop which owns the shared browser,
+    starting the loop if need be, and return its result."""
+    global _LOOP
+    with _loop_lock:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _LOOP).result()
+
+
+async def _get_browser():
+    """Get the shared browser, launching it the first time."""
+    from playwright.async_api import async_playwright
+
+    global _PLAYWRIGHT, _BROWSER, _BROWSER_LAUNCH_LOCK
+    if _BROWSER_LAUNCH_LOCK is None:
+        _BROWSER_LAUNCH_LOCK = asyncio.Lock()
+    async with _BROWSER_LAUNCH_LOCK:
+        if _BROWSER is None:
+            _PLAYWRIGHT = await async_playwright().start()
+            _BROWSER = await _PLAYWRIGHT.chromium.launch(args=BROWSER_ARGS)
+    return _BROWSER
+
+
+async def _close_browser():
+    """Close the shared browser and stop Playwright."""
+    global _PLAYWRIGHT, _BROWSER
+    if _BROWSER is not None:
+        await _BROWSER.close()
+        await _PLAYWRIGHT.stop()
+        _PLAYWRIGHT, _BROWSER = None, None
+
+
+@atexit.register
+def _shut_down_browser():
+    """Close the shared browser when the process exits."""
+    if _LOOP is not None:
+        _run_in_browser_loop(_close_browser())
+        _LOOP.call_soon_threadsafe(_LOOP.stop)
+
+
+async def _scrape_hrefs_async(urls, max_concurrency=MAX_CONCURRENT_PAGES):
+    """Visits every url concurrently with the shared browser, and grabs the
+    hrefs of all of their links. Returns one list per url."""
+    browser = await _get_browser()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(
+        *[_get_hrefs_from_page(browser, url, semaphore) for url in urls]
+    )
 
 
 def get_self_links_and_pdf_links_from_url(url):
     """Visits a url and grabs all the links that link back to itself."""
-    with sync_playwright() as playwright:
-        browser = playwright.chromium.launch()
-        page = browser.new_page()
-        page.goto(url)
-        page.wait_for_load_state("networkidle")
-        links = page.query_selector_all("a")
-        original_domain = _get_domain_of_url(url)
-        relevant_links = []
-        for link in links:
-            href = link.get_attribute("href")
-            if href is None:
-                continue
-            domain = _get_domain_of_url(href)
-            if domain == original_domain or href.startswith("/") or href.endswith(
-                ".pdf"
-            ):
-                relevant_links.append(href)
-
-        browser.close()
-        return relevant_links
+    return get_all_links_batch([url])[url]
+
+
+def get_all_links_batch(urls):
+    """Visits several urls at once and grabs, for each of them, all the links
+    that link back to itself. Returns a dict of url => links."""
+    return _collect_links_batch(urls)
+
+
+def _collect_links_batch(urls, pdf_only=False):
+    """Get the relevant links of each of the urls, as a dict of url => links.
+    Pages are read from their HTML where possible, and only rendered in the
+    browser if they need JavaScript for their links."""
+    urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as executor:
+        hrefs_by_url = dict(zip(urls, executor.map(_get_static_hrefs, urls)))
+    to_render = [url for url, hrefs in hrefs_by_url.items() if hrefs is None]
+    if to_render:
+        rendered = _run_in_browser_loop(_scrape_hrefs_async(to_render))
+        hrefs_by_url.update(zip(to_render, rendered))
+    return {
+        url: _get_relevant_links(url, hrefs, pdf_only=pdf_only)
+        for url, hrefs in hrefs_by_url.items()
+    }
 
 
 def get_pdf_links(url):
     """Visits a url and grabs all the links that end with pdf."""
-    links = get_self_links_and_pdf_links_from_url(url)
-    pdf_links = []
-    for link in links:
-        if link.endswith(".pdf"):
-            pdf_links.append(link)
-    return pdf_links
+    return _collect_links_batch([url], pdf_only=True)[url]
 
 
-def _choose_url_template(urls, where_am_i=None, objective=None):
-    """Set up a prompt to OpenAI to ask for what the right link is."""
+def _shortlist_urls(urls):
+    """Dedupe the urls and keep the ones worth showing the model, in the
+    order they were given."""
+    urls = list(dict.fromkeys(urls))
+    relevant = [url for url in urls if RELEVANT_URL_RE.search(url)]
+    relevant = relevant[:MAX_RELEVANT_URLS]
+    others = [url for url in urls if not RELEVANT_URL_RE.search(url)]
+    others = sorted(others, key=len)[:MAX_OTHER_URLS]
+    kept = set(relevant + others)
+    return [url for url in urls if url in kept]
+
+
+INVESTOR_RELATIONS_OBJECTIVE = """I would like to get to the investor relations page, and in particular, any "events and presentations" page that may exist.
+It shouldn\'t be a url that leads to a specific announcement, but rather to the page which contains all the announcements.
+Sometimes it will be called "Investors", "Investor Relations", or "IR".
+It should be the shortest link that leads to the investor relations page.
+Please choose the url which links to the investor relations page or which you think will most likely link to the investor relations page."""
+
+EVENTS_AND_PRESENTATION_OBJECTIVE = """I would like to get to the events and presentations page, or better yet, to the latest presentation.
+It shouldn\'t be a url that leads to a specific announcement, but rather to the page which contains all the presentations.
+It should be the shortest link that leads to events and presentations page, or ideally, just the presentations page."""
+
+
+def _get_latest_presentation_objective():
+    """The objective for choosing the latest presentation, as of today."""
+    todays_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    return f"I would like to get to the latest investor presentation or earnings presentation. Today's date is {todays_date}."
+
+
+def _get_choose_url_request(urls, where_am_i=None, objective=None):
+    """Set up a prompt to OpenAI to ask for what the right link is. Returns
+    the system prompt, the prompt, the model to send them to, and the key
+    the answer is cached under."""
     assert (
         where_am_i is not None
     ), "Must give a description of where the urls came from."
     assert objective is not None, "Must give an objective for choosing the urls."
-    prompt = f"""Below, you are given a list of URLs found on a publicly traded company's front page.
+    # The instructions are the same for every call with this objective, so
+    # they are sent as the system prompt, ahead of the urls, where the
+    # provider can reuse its prompt cache for them.
+    system = f"""Below, you are given a list of URLs found on a publicly traded company's front page.
 
-{objective}\n\n"""
+{objective}
 
-    for url in urls:
-        prompt += f"{url}\n"
+Please return your answer with the URL alone, with no other commentary or HTML tags. Do not enclose it in quotes as a string."""
 
-    prompt += "\nPlease return your answer with the URL alone, with no other commentary or HTML tags. Do not enclose it in quotes as a string."
+    urls = _shortlist_urls(urls)
+    prompt = "".join(f"{url}\n" for url in urls)
     prompt += "\nYour answer: "
-    completion = get_completion(prompt, model="gpt-3.5-turbo-16k")
+    model = CHOOSE_URL_MODEL
+    if len(urls) < MAX_RELEVANT_URLS:
+        model = CHOOSE_URL_SHORT_MODEL
+    return system, prompt, model, content_hash(model, system, prompt)
+
+
+def _get_cached_choice(key, model):
+    """Get a cached answer, if the on-disk cache is enabled and has one."""
+    if _CHOOSE_URL_CACHE is None:
+        return None
+    return _CHOOSE_URL_CACHE.get_completion(
+        key, "openai", model, ttl=CHOOSE_URL_CACHE_TTL
+    )
+
+
+def _cache_choice(key, model, completion):
+    """Cache an answer, unless the API returned an error instead."""
+    if _CHOOSE_URL_CACHE is not None and isinstance(completion, str):
+        _CHOOSE_URL_CACHE.put_completion(key, "openai", model, completion)
+
+
+def _choose_url_template(urls, where_am_i=None, objective=None):
+    """Ask OpenAI for what the right link is."""
+    system, prompt, model, key = _get_choose_url_request(urls, where_am_i, objective)
+    completion = _get_cached_choice(key, model)
+    if completion is None:
+        completion = get_completion(
+            prompt, model=model, max_tokens=CHOOSE_URL_MAX_TOKENS, system=system
+        )
+        _cache_choice(key, model, completion)
     return completion
 
 
 def choose_investor_relations_url(urls):
     """In the list of urls given, find the one that links to the investor relations page."""
-    objective = """I would like to get to the investor relations page, and in particular, any "events and presentations" page that may exist.
-It shouldn\'t be a url that leads to a specific announcement, but rather to the page which contains all the announcements.
-Sometimes it will be called "Investors", "Investor Relations", or "IR".
-It should be the shortest link that leads to the investor relations page.
-Please choose the url which links to the investor relations page or which you think will most likely link to the investor relations page."""
     return _choose_url_template(
-        urls, where_am_i="publicly traded company's front page", objective=objective
+        urls,
+        where_am_i="publicly traded company's front page",
+        objective=INVESTOR_RELATIONS_OBJECTIVE,
     )
 
 
 def choose_events_and_presentation_url(urls):
     """In the list of urls given, find the one that links to the events and presentations url."""
-    objective = """I would like to get to the events and presentations page, or better yet, to the latest presentation.
-It shouldn\'t be a url that leads to a specific announcement, but rather to the page which contains all the presentations.
-It should be the shortest link that leads to events and presentations page, or ideally, just the presentations page."""
     return _choose_url_template(
         urls,
         where_am_i="publicly traded company's investor relations page",
-        objective=objective,
+        objective=EVENTS_AND_PRESENTATION_OBJECTIVE,
     )
 
 
 def choose_latest_presentation_url(urls):
     """In the list of urls given, find the one that links to the latest presentation."""
-    todays_date = datetime.datetime.now().strftime("%Y-%m-%d")
-    objective = "I would like to get to the latest investor presentation or earnings presentation. Today's date is {todays_date}."
     return _choose_url_template(
         urls,
         where_am_i="publicly traded company's events and presentations page",
-        objective=objective,
+        objective=_get_latest_presentation_objective(),
     )
 
 
+def _is_already_downloaded(url, save_path):
+    """Whether the PDF at `url` seems to be the one already at `save_path`,
+    judging by its size, which is asked for with a HEAD request."""
+    import requests
+
+    try:
+        head = _get_session().head(
+            url, headers=DOWNLOAD_HEADERS, allow_redirects=True, timeout=10
+        )
+    except requests.RequestException:
+        return False
+    length = head.headers.get("Content-Length")
+    return (
+        head.ok
+        and length is not None
+        and length.isdigit()
+        and int(length) == os.path.getsize(save_path)
+    )
+
+
+def _get_save_path(url):
+    """Get the path to save the PDF at `url` to. It is named after the url's
+    file name plus a hash of the whole url, so that PDFs with the same file
+    name from different companies or quarters don't overwrite each other."""
+    name = url.split("/")[-1]
+    if _is_pdf_link(name):
+        name = name[: -len(".pdf")]
+    return f"{name}-{content_hash(url)[:8]}.pdf"
+
+
 def download_pdf(url):
-    """Download a PDF from a url."""
-    assert url.endswith(".pdf"), "Provided url must be a PDF."
+    """Download a PDF from a url, unless it was downloaded already. Returns
+    the path it was saved to."""
+    assert _is_pdf_link(url), "Provided url must be a PDF."
     if url.startswith("//"):
         url = "https:" + url
 
-    response = requests.get(url)
-    response.raise_for_status()
-
-    save_path = url.split("/")[-1]
-    if not save_path.endswith(".pdf"):
-        save_path += ".pdf"
-    with open(save_path, "wb") as file:
-        file.write(response.content)
+    save_path = _get_save_path(url)
+    with _download_locks_lock:
+        lock = _download_locks.setdefault(save_path, threading.Lock())
+    with lock:
+        if os.path.exists(save_path) and _is_already_downloaded(url, save_path):
+            return save_path
+
+        # Download to a temporary file first, so that an interrupted download
+        # is never mistaken for a complete one.
+        partial_path = save_path + ".part"
+        with _get_session().get(
+            url, headers=DOWNLOAD_HEADERS, stream=True, timeout=30
+        ) as response:
+            response.raise_for_status()
+            with open(partial_path, "wb") as file:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+        os.replace(partial_path, save_path)
+    return save_path
+
+
+def download_pdfs(urls):
+    """Download several PDFs at once. Returns the paths they were saved to."""
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
+        return list(executor.map(download_pdf, urls))
 
 
 def main():
@@ -148,6 +510,11 @@ def main():
             description="Get relevant links from a url (links that link back to its own domain and links to PDFs).",
             function=get_self_links_and_pdf_links_from_url,
         ),
+        Action(
+            name="get_all_links_batch",
+            description="Get relevant links from several urls at once. Returns a dict of url to its links.",
+            function=get_all_links_batch,
+        ),
         Action(
             name="get_pdf_links",
             description="Get all the PDF links from a url.",
@@ -173,6 +540,11 @@ def main():
             description="Download a PDF from a url",
             function=download_pdf,
         ),
+        Action(
+            name="download_pdfs",
+            description="Download several PDFs at once, given a list of urls",
+            function=download_pdfs,
+        ),
     ]
 
     ticker = "EQT"
@@ -8,6 +8,11 @@ DOCUMENTS = {
 }
 
 
+def speak(text):
+    """Speak the given text."""
+    print(text)
+
+
 if __name__ == "__main__":
     agent = AgenticGPT(
         "What is a capybara? Print out the answer.",
@@ -15,7 +20,7 @@ if __name__ == "__main__":
             Action(
                 name="speak",
                 description="Speak the given text.",
-                function=lambda text: print(text),
+                function=speak,
             )
         ],
         memory_dict=DOCUMENTS,